@@ -1,38 +1,48 @@
 import {API_ANALYZE} from "./config.ts";
 
 export interface AnalyzeResult {
-    image: File;
+    image: File | null;
     status: string;
     detections: string;
     description: string;
     time: number;
+    nextCaptureDelay: number;
 }
 
 let imageCounter: number = 0;
 
-export async function analyze(image: File): Promise<AnalyzeResult> {
+// capturedAt is a performance.now() timestamp, only the age of the frame is sent,
+// so that the clock of the browser does not have to agree with the clock of the server
+export async function analyze(image: File, capturedAt: number): Promise<AnalyzeResult> {
     console.log(`POST request to: ${API_ANALYZE}`);
     const formData = new FormData();
     formData.append('file', image);
+    formData.append('frame_age', (performance.now() - capturedAt).toString());
 
     const response: Response = await fetch(API_ANALYZE, {
         method: 'POST',
         body: formData,
         credentials: 'include'
     });
-    console.assert(response.ok, `Failed to analyze image, response status: ${response.status}`);
+    if (!response.ok) {
+        throw new Error(`Failed to analyze image, response status: ${response.status}`);
+    }
 
     const result = await response.json();
     console.assert(
-        ['success', 'indifferent', 'busy'].includes(result.status),
+        ['success', 'indifferent', 'busy', 'expired', 'superseded'].includes(result.status),
         `Invalid status: ${result.status}`
     );
 
-    const decodedImageBlob: Blob = await fetch(`data:image/png;base64,${result.image}`)
-        .then(res => res.blob());
-    const decodedImageFile = new File(
-        [decodedImageBlob], `decodedImage${imageCounter++}.png`, {type: 'image/png'}
-    );
+    // Expired and superseded frames are dropped by the server before inference and come back without an image
+    let decodedImageFile: File | null = null;
+    if (result.image !== null) {
+        const decodedImageBlob: Blob = await fetch(`data:image/png;base64,${result.image}`)
+            .then(res => res.blob());
+        decodedImageFile = new File(
+            [decodedImageBlob], `decodedImage${imageCounter++}.png`, {type: 'image/png'}
+        );
+    }
 
     console.log(
         `status: ${result.status}, detections: ${result.detections}, 
@@ -44,6 +54,7 @@ export async function analyze(image: File): Promise<AnalyzeResult> {
         status: result.status,
         detections: result.detections,
         description: result.description,
-        time: result.time
+        time: result.time,
+        nextCaptureDelay: result.next_capture_delay
     };
 }
\ No newline at end of file
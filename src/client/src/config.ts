@@ -1,3 +1,4 @@
+// Capture delay in milliseconds used until the server suggests one, and after failed requests
 export const UPDATE_INTERVAL: number = 500;
 export const MAX_ELEMENTS: number = 50;
 
@@ -62,18 +62,34 @@ function setupAnalyze(
     detectedImage: HTMLImageElement, detectedText: HTMLParagraphElement,
     outputList: HTMLUListElement
 ): void {
-    setInterval(async function () {
-        await analyzeAndUpdate(videoManager, detectedImage, detectedText, outputList);
-    }, UPDATE_INTERVAL);
+    // The next capture is scheduled only once the previous request completed, following the server's hint
+    const analyzeLoop = async function (): Promise<void> {
+        let delay: number = UPDATE_INTERVAL;
+        try {
+            delay = await analyzeAndUpdate(videoManager, detectedImage, detectedText, outputList);
+        } catch (err) {
+            console.error("Failed to analyze image: ", err);
+        }
+        setTimeout(analyzeLoop, delay);
+    };
+    setTimeout(analyzeLoop, UPDATE_INTERVAL);
 }
 
+// Returns the delay in milliseconds before the next capture
 async function analyzeAndUpdate(
     videoManager: VideoManager,
     detectedImage: HTMLImageElement, detectedText: HTMLParagraphElement,
     outputList: HTMLUListElement
-): Promise<void> {
+): Promise<number> {
+    const capturedAt: number = performance.now();
     const image: File = await videoManager.getVideoFrameUnsafe();
-    const analyzeResult: AnalyzeResult = await analyze(image);
+    const analyzeResult: AnalyzeResult = await analyze(image, capturedAt);
+    const delay: number = analyzeResult.nextCaptureDelay * 1000;
+
+    if (analyzeResult.image === null) {
+        console.log(`status: ${analyzeResult.status}, frame was dropped, skipping update`);
+        return delay;
+    }
 
     if (detectedImage.src !== '/hailo.png') {
         URL.revokeObjectURL(detectedImage.src);
@@ -85,7 +101,7 @@ async function analyzeAndUpdate(
 
     if (analyzeResult.status !== 'success') {
         console.log(`status: ${analyzeResult.status}, skipping output list update`);
-        return;
+        return delay;
     }
 
     // speak the description using tts and update the output list
@@ -119,6 +135,7 @@ async function analyzeAndUpdate(
     li.appendChild(img);
     li.appendChild(p);
     outputList.insertBefore(li, outputList.firstChild);
+    return delay;
 }
 
 function speak(text: string): void {
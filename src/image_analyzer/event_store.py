@@ -0,0 +1,224 @@
+import asyncio
+import json
+import sqlite3
+import time
+from dataclasses import dataclass
+from logging import getLogger
+from pathlib import Path
+from typing import Any, Optional
+
+__all__ = ["Event", "EventStore"]
+
+logger = getLogger(__name__)
+
+schema: str = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    user TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    status TEXT NOT NULL,
+    class_counts TEXT NOT NULL,
+    boxes TEXT NOT NULL,
+    description TEXT NOT NULL,
+    timings TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_user_timestamp ON events (user, timestamp);
+CREATE INDEX IF NOT EXISTS events_timestamp ON events (timestamp);
+CREATE TABLE IF NOT EXISTS event_classes (
+    event_id INTEGER NOT NULL REFERENCES events (id),
+    class_name TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    user TEXT NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS event_classes_class_user_timestamp_id
+    ON event_classes (class_name, user, timestamp, event_id);
+CREATE INDEX IF NOT EXISTS event_classes_class_timestamp_id ON event_classes (class_name, timestamp, event_id);
+CREATE INDEX IF NOT EXISTS event_classes_timestamp ON event_classes (timestamp);
+"""
+
+
+@dataclass(frozen=True)
+class Event:
+    user: str
+    timestamp: float
+    status: str
+    class_counts: dict[str, int]
+    # (class_id, score, ymin, xmin, ymax, xmax), the box normalized to the original image
+    boxes: list[tuple[int, float, float, float, float, float]]
+    description: str
+    timings: dict[str, float]
+
+
+def connect(path: Path) -> sqlite3.Connection:
+    connection: sqlite3.Connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+class EventStore:
+    """
+    Append-only log of analyzed frames in a SQLite database in WAL mode.
+
+    append never blocks: events are buffered and written in batches by a background task,
+    off the request path. Events are dropped with a warning if the buffer is full.
+    Events older than retention seconds are deleted by the writer, at most every prune_interval seconds.
+    """
+
+    def __init__(
+            self, path: Path, batch_size: int = 256, flush_interval: float = 1., max_buffered: int = 10000,
+            retention: Optional[float] = None, prune_interval: float = 60.
+    ):
+        self.path: Path = path
+        self.batch_size: int = batch_size
+        self.flush_interval: float = flush_interval
+        self.retention: Optional[float] = retention
+        self.prune_interval: float = prune_interval
+        self.pruned_at: float = 0.
+        self.queue: asyncio.Queue[Event] = asyncio.Queue(maxsize=max_buffered)
+        self.connection: sqlite3.Connection = connect(path)
+        self.connection.executescript(schema)
+        self.writer: Optional[asyncio.Task] = None
+        self.stopping: asyncio.Event = asyncio.Event()
+        # Whether the writer holds no events, only then can it be cancelled without losing any
+        self.idle: bool = True
+
+    def start(self) -> None:
+        self.writer = asyncio.create_task(self.write_loop())
+
+    async def stop(self) -> None:
+        if self.writer is not None:
+            self.stopping.set()
+            if self.idle:
+                self.writer.cancel()
+            try:
+                await self.writer
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        self.connection.close()
+
+    def append(self, event: Event) -> None:
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            logger.warning(f"Event buffer is full, dropping event for user {event.user}")
+
+    def drain(self) -> list[Event]:
+        events: list[Event] = []
+        while not self.queue.empty() and len(events) < self.batch_size:
+            events.append(self.queue.get_nowait())
+        return events
+
+    async def flush(self) -> None:
+        while events := self.drain():
+            await asyncio.to_thread(self.write, events)
+
+    async def write_loop(self) -> None:
+        while not self.stopping.is_set():
+            # Wait for the first event, then give the batch flush_interval to fill up, or until stop is called
+            self.idle = True
+            event: Event = await self.queue.get()
+            self.idle = False
+            if self.queue.qsize() < self.batch_size - 1:
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            events: list[Event] = [event] + self.drain()
+            try:
+                await asyncio.to_thread(self.write, events)
+            except sqlite3.Error:
+                logger.exception(f"Failed to write {len(events)} events")
+
+    def write(self, events: list[Event]) -> None:
+        with self.connection:
+            for event in events:
+                cursor: sqlite3.Cursor = self.connection.execute(
+                    "INSERT INTO events (user, timestamp, status, class_counts, boxes, description, timings) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        event.user, event.timestamp, event.status,
+                        json.dumps(event.class_counts, separators=(",", ":")),
+                        json.dumps(event.boxes, separators=(",", ":")),
+                        event.description,
+                        json.dumps(event.timings, separators=(",", ":")),
+                    )
+                )
+                self.connection.executemany(
+                    "INSERT INTO event_classes (event_id, class_name, count, user, timestamp) VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (cursor.lastrowid, class_name, count, event.user, event.timestamp)
+                        for class_name, count in event.class_counts.items()
+                    ]
+                )
+            if self.retention is not None and time.time() - self.pruned_at >= self.prune_interval:
+                self.prune(time.time() - self.retention)
+        logger.info(f"Wrote {len(events)} events")
+
+    def prune(self, before: float) -> None:
+        self.pruned_at = time.time()
+        self.connection.execute("DELETE FROM event_classes WHERE timestamp < ?", (before,))
+        deleted: int = self.connection.execute("DELETE FROM events WHERE timestamp < ?", (before,)).rowcount
+        if deleted:
+            logger.info(f"Deleted {deleted} events older than {before}")
+
+    async def query(
+            self, user: Optional[str] = None, class_name: Optional[str] = None,
+            since: Optional[float] = None, until: Optional[float] = None, until_id: Optional[int] = None,
+            limit: int = 100
+    ) -> list[dict[str, Any]]:
+        """
+        Query events, newest first.
+        :param user: Only events of this user.
+        :param class_name: Only events in which this class was detected.
+        :param since: Only events at or after this timestamp.
+        :param until: Only events before this timestamp.
+        :param until_id: With until, also the events at the until timestamp with a smaller id. Pass the timestamp
+                         and the id of the last event to get the next page, events sharing a timestamp are not skipped.
+        :param limit: The maximum number of events to return.
+        :return: The events, with their ids.
+        """
+        table: str = "event_classes" if class_name is not None else "events"
+        id_column: str = f"{table}.event_id" if class_name is not None else f"{table}.id"
+        conditions: list[str] = []
+        params: list[Any] = []
+        for column, operator, value in (
+                ("class_name", "=", class_name), ("user", "=", user), ("timestamp", ">=", since)
+        ):
+            if value is not None:
+                conditions.append(f"{table}.{column} {operator} ?")
+                params.append(value)
+        if until is not None and until_id is not None:
+            conditions.append(f"({table}.timestamp, {id_column}) < (?, ?)")
+            params += [until, until_id]
+        elif until is not None:
+            conditions.append(f"{table}.timestamp < ?")
+            params.append(until)
+        where: str = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        sql: str = (
+            f"SELECT events.* FROM {table} "
+            + ("JOIN events ON events.id = event_classes.event_id " if class_name is not None else "")
+            + f"{where} ORDER BY {table}.timestamp DESC, {id_column} DESC LIMIT ?"
+        )
+        return await asyncio.to_thread(self.read, sql, params + [limit])
+
+    def read(self, sql: str, params: list[Any]) -> list[dict[str, Any]]:
+        # Readers get their own connection, WAL lets them run concurrently with the writer
+        connection: sqlite3.Connection = sqlite3.connect(self.path)
+        connection.row_factory = sqlite3.Row
+        try:
+            rows: list[sqlite3.Row] = connection.execute(sql, params).fetchall()
+        finally:
+            connection.close()
+
+        return [
+            {
+                "id": row["id"], "user": row["user"], "timestamp": row["timestamp"], "status": row["status"],
+                "class_counts": json.loads(row["class_counts"]), "boxes": json.loads(row["boxes"]),
+                "description": row["description"], "timings": json.loads(row["timings"]),
+            }
+            for row in rows
+        ]
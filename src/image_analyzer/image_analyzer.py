@@ -1,17 +1,24 @@
+import math
 import time
 from collections import defaultdict
 from logging import getLogger
-from typing import Any, Optional
+from typing import Any, Awaitable, Callable, Optional, TypeVar
 
+import numpy as np
 from PIL import Image
 
+from image_analyzer.event_store import Event, EventStore
 from image_analyzer.image_describer.image_describer import ImageDescribed, ImageDescriber
-from image_analyzer.object_detector.object_detector import ImageObjectDetected, ObjectDetector
+from image_analyzer.object_detector.frame_scheduler import ADMITTED, Frame, FrameScheduler
+from image_analyzer.object_detector.object_detector import DetectionSet, ImageObjectDetected, ObjectDetector
+from image_analyzer.tracing import get_timings, span, trace
 
 __all__ = ["ImageAnalyzer"]
 
 logger = getLogger(__name__)
 
+T = TypeVar("T")
+
 
 def get_last_element(lst: list[Any]) -> Optional[Any]:
     """
@@ -27,55 +34,182 @@ def is_different(image1: ImageObjectDetected, image2: Optional[ImageObjectDetect
     if image2 is None:
         return True
 
-    image1_detections: defaultdict[str, int] = defaultdict(int)
-    image2_detections: defaultdict[str, int] = defaultdict(int)
+    return image1.detections.signature != image2.detections.signature
+
 
-    for detection in image1.detections:
-        image1_detections[detection.class_name] += 1
-    for detection in image2.detections:
-        image2_detections[detection.class_name] += 1
+def get_new_detections(image1: ImageObjectDetected, image2: Optional[ImageObjectDetected]) -> DetectionSet:
+    """
+    Get the detections of the objects in image1 that were not in image2. Objects are not tracked,
+    so the new objects of a class are taken to be its highest scoring detections beyond the count in image2.
+    """
+    if image2 is None:
+        return image1.detections
 
-    return set(image1_detections.items()) != set(image2_detections.items())
+    detections: DetectionSet = image1.detections
+    prev_counts: dict[str, int] = dict(image2.detections.class_counts)
+    is_new: np.ndarray = np.ones(len(detections), dtype=bool)
+    for i in np.argsort(detections.scores, kind="stable").tolist():
+        # Walking up from the lowest scores, the first prev_counts detections of a class were already there
+        class_name: str = detections.names[int(detections.class_ids[i])]
+        if prev_counts.get(class_name, 0) > 0:
+            prev_counts[class_name] -= 1
+            is_new[i] = False
+    return detections[is_new]
 
 
 class ImageAnalyzer:
-    def __init__(self, object_detector: ObjectDetector, image_describer: ImageDescriber):
+    def __init__(
+            self, object_detector: ObjectDetector, image_describer: ImageDescriber,
+            max_frame_age: float = 2.,
+            min_capture_delay: float = .5, max_capture_delay: float = 2., static_backoff_frames: int = 4,
+            event_store: Optional[EventStore] = None
+    ):
         self.object_detector = object_detector
         self.image_describer = image_describer
+        self.event_store: Optional[EventStore] = event_store
+        # Frames older than max_frame_age seconds are dropped before inference
+        self.max_frame_age: float = max_frame_age
+        self.frame_scheduler: FrameScheduler = FrameScheduler()
+
+        # Bounds of the capture delay suggested to the clients, in seconds
+        self.min_capture_delay: float = min_capture_delay
+        self.max_capture_delay: float = max_capture_delay
+        # The suggested delay doubles every static_backoff_frames consecutive unchanged frames
+        self.static_backoff_frames: int = static_backoff_frames
+        # Past this many unchanged frames the delay is at max_capture_delay, counting further would only overflow
+        self.max_static_frames: int = static_backoff_frames * (
+            math.ceil(math.log2(max_capture_delay / min_capture_delay)) if min_capture_delay > 0 else 0
+        )
+        # Exponential moving average of the object detector latency, in seconds
+        self.detector_latency: float = 0.
+        self.static_frames: defaultdict[str, int] = defaultdict(int)
 
         self.history: defaultdict[str, list[ImageObjectDetected]] = defaultdict(list)
 
-    async def analyze_image(self, user: str, image_raw: Image.Image) -> ImageDescribed:
+    def suggest_capture_delay(self, user: str) -> float:
+        """
+        Suggest how long the user should wait before capturing the next frame, in seconds.
+        The delay grows with the time the detector needs to drain its queue and while the user's scene is static.
+        """
+        queue_depth: int = self.frame_scheduler.pending() + self.frame_scheduler.busy
+        queue_delay: float = queue_depth * self.detector_latency
+        static_frames: int = min(self.static_frames[user], self.max_static_frames)
+        static_delay: float = self.min_capture_delay * 2 ** (static_frames // self.static_backoff_frames)
+        return min(self.max_capture_delay, max(self.min_capture_delay, queue_delay, static_delay))
+
+    def create_frame(self, user: str, image_raw: Image.Image, arrival: float, frame_age: Optional[float]) -> Frame:
+        """
+        :param arrival: When the frame reached the server, on the server clock.
+        :param frame_age: How long the client held the frame before uploading it, in seconds. Measured on the client
+                          clock alone, so that clock skew between the client and the server does not matter.
+        """
+        captured_at: float = arrival - max(frame_age or 0., 0.)
+        return Frame(image=image_raw, user=user, captured_at=captured_at, deadline=captured_at + self.max_frame_age)
+
+    async def run_object_detector(
+            self, frame: Frame, detect: Callable[[Image.Image], Awaitable[T]]
+    ) -> tuple[str, Optional[T]]:
+        """
+        Run the object detector on the frame once the frame scheduler admits it.
+        :return: "success" and the result of detect, or "expired" or "superseded" and None if the frame was
+                 dropped before inference.
+        """
+        with span("queue"):
+            admission: str = await self.frame_scheduler.acquire(frame)
+        if admission != ADMITTED:
+            logger.info(f"Frame {admission} before inference for user {frame.user}")
+            return admission, None
+        try:
+            time_s: float = time.time()
+            result: T = await detect(frame.image)
+            self.detector_latency = .8 * self.detector_latency + .2 * (time.time() - time_s)
+        finally:
+            self.frame_scheduler.release()
+        return "success", result
+
+    async def detect(
+            self, user: str, image_raw: Image.Image, frame_age: Optional[float] = None
+    ) -> tuple[str, Optional[DetectionSet]]:
+        """
+        Detect objects without drawing, history or description.
+        :return: The status and the detections with boxes normalized to image_raw,
+                 None if the frame was dropped before inference.
+        """
+        frame: Frame = self.create_frame(user, image_raw, time.time(), frame_age)
+        return await self.run_object_detector(frame, self.object_detector.detect_boxes)
+
+    async def analyze_image(
+            self, user: str, image_raw: Image.Image, arrival: float, frame_age: Optional[float] = None
+    ) -> ImageDescribed:
         logger.info(f"Analyzing image for user {user}, user history length: {len(self.history[user])}")
         time_s: float = time.time()
-        image: ImageObjectDetected = await self.object_detector.detect(image_raw)
+        frame: Frame = self.create_frame(user, image_raw, arrival, frame_age)
+
+        detect_status, image = await self.run_object_detector(frame, self.object_detector.detect)
+        if image is None:
+            return ImageDescribed(
+                image=ImageObjectDetected(image=image_raw, image_detected=image_raw, detections=DetectionSet.empty()),
+                description="", status=detect_status, time=time.time() - time_s, timings=get_timings()
+            )
 
         prev_image: Optional[ImageObjectDetected] = get_last_element(self.history[user])
 
         if not is_different(image, prev_image):
             logger.info(f"Image is the same as the previous image for user {user}")
+            self.static_frames[user] = min(self.static_frames[user] + 1, self.max_static_frames)
             return ImageDescribed(
-                image=image, description="", status="indifferent", time=time.time() - time_s
+                image=image, description="", status="indifferent", time=time.time() - time_s, timings=get_timings()
             )
 
+        self.static_frames[user] = 0
         self.history[user].append(image)
-        image_described: ImageDescribed = await self.image_describer.describe(image)
+        image_described: ImageDescribed = await self.image_describer.describe(
+            image, get_new_detections(image, prev_image)
+        )
         return ImageDescribed(
             image=image,
             description=image_described.description, status=image_described.status,
-            time=time.time() - time_s
+            time=time.time() - time_s, timings=get_timings()
         )
 
-    async def analyze(self, user: str, image_raw: Image.Image) -> ImageDescribed:
-        image_described: ImageDescribed = await self.analyze_image(user, image_raw)
+    def create_event(self, user: str, arrival: float, image_described: ImageDescribed) -> Event:
+        image: ImageObjectDetected = image_described.image
+        detections: DetectionSet = self.object_detector.to_image_boxes(image.detections, image.image.size)
+        boxes: list[tuple[int, float, float, float, float, float]] = [
+            (class_id, score, ymin, xmin, ymax, xmax)
+            for class_id, (score, ymin, xmin, ymax, xmax) in zip(
+                detections.class_ids.tolist(),
+                np.column_stack([detections.scores, detections.boxes]).round(4).tolist()
+            )
+        ]
+
+        return Event(
+            user=user, timestamp=arrival,
+            status=image_described.status, class_counts=dict(image.detections.class_counts), boxes=boxes,
+            description=image_described.description,
+            timings={**image_described.timings, "total": image_described.time}
+        )
+
+    async def analyze(
+            self, user: str, image_raw: Image.Image, frame_age: Optional[float] = None
+    ) -> ImageDescribed:
+        # Timestamps come from the server clock, the client clock may be skewed
+        arrival: float = time.time()
+        # Joins the trace of the request if there is one
+        with trace():
+            image_described: ImageDescribed = await self.analyze_image(user, image_raw, arrival, frame_age)
         logger.info(f"image_described: {image_described}")
-        assert image_described.status in ["success", "indifferent", "busy"], (
+        assert image_described.status in ["success", "indifferent", "busy", "expired", "superseded"], (
             f"Unexpected status: {image_described.status}"
         )
 
+        if self.event_store is not None:
+            self.event_store.append(self.create_event(user, arrival, image_described))
+
         return image_described
 
     def refresh(self, user: str) -> None:
+        self.static_frames.pop(user, None)
         if user not in self.history:
             logger.info(f"User {user} not found in history")
         else:
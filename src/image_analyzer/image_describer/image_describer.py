@@ -1,31 +1,55 @@
 import asyncio
+import base64
+import io
 import time
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from logging import getLogger
-from typing import final
+from typing import Optional, final
 
 from PIL import Image
 
-from image_analyzer.object_detector.object_detector import ImageObjectDetected
+from image_analyzer.object_detector.object_detector import DetectionSet, ImageObjectDetected
+from image_analyzer.tracing import span
 
-__all__ = ["ImageDescribed", "ImageDescriber", "DummyImageDescriber"]
+__all__ = ["ImageDescribed", "ImageDescriber", "DummyImageDescriber", "base64encode", "create_image_describer"]
 
 logger = getLogger(__name__)
 
 
+def base64encode(image: Image.Image) -> str:
+    """
+    Encode an image as a base64 string.
+    :param image: The image to encode.
+    :return: The base64 string.
+    """
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+
 @dataclass(frozen=True)
 class ImageDescribed:
     image: ImageObjectDetected
     description: str
     status: str
     time: float
+    # Duration of each stage of the analysis in seconds, by stage name
+    timings: dict[str, float] = field(default_factory=dict)
 
 
 class ImageDescriber(ABC):
-    def __init__(self, max_w_h: int):
+    def __init__(self, max_w_h: int, max_concurrent: int = 1):
         self.max_w_h: int = max_w_h
-        self.processing: bool = False
+        # Describers that batch requests accept several at a time, the others are busy while describing
+        self.max_concurrent: int = max_concurrent
+        self.in_flight: int = 0
+        # Requests sent to the model, one request may describe several images
+        self.model_calls: int = 0
+
+    @property
+    def processing(self) -> bool:
+        return self.in_flight >= self.max_concurrent
 
     @final
     def preprocess(self, image: Image.Image) -> Image.Image:
@@ -42,21 +66,32 @@ class ImageDescriber(ABC):
         )
 
     @abstractmethod
-    async def describe_image(self, image: ImageObjectDetected) -> str:
+    async def describe_image(self, image: ImageObjectDetected, new_detections: DetectionSet) -> str:
+        """
+        :param image: The image to describe.
+        :param new_detections: The detections of the objects that appeared since the previous image.
+        :return: The description.
+        """
         pass
 
     @final
-    async def describe(self, image: ImageObjectDetected) -> ImageDescribed:
+    async def describe(
+            self, image: ImageObjectDetected, new_detections: Optional[DetectionSet] = None
+    ) -> ImageDescribed:
         if self.processing:
             logger.info("Already processing an image")
             return ImageDescribed(image=image, description="", status="busy", time=-1.)
 
-        self.processing = True
+        self.in_flight += 1
         time_s: float = time.time()
 
-        description = await self.describe_image(image)
-
-        self.processing = False
+        try:
+            with span("describe"):
+                description = await self.describe_image(
+                    image, image.detections if new_detections is None else new_detections
+                )
+        finally:
+            self.in_flight -= 1
         time_delta: float = time.time() - time_s
         logger.info(f"Described the image in {time_delta:.2f} seconds, description: {description}")
 
@@ -64,11 +99,48 @@ class ImageDescriber(ABC):
             image=image, description=description, status="success", time=time_delta
         )
 
+    @final
+    async def warm_up(self) -> float:
+        """
+        Describe a blank image so that the first real request does not pay for model loading.
+        :return: The duration of the warm-up description in seconds.
+        """
+        image_blank: Image.Image = Image.new('RGB', (self.max_w_h, self.max_w_h))
+        image: ImageObjectDetected = ImageObjectDetected(
+            image=image_blank, image_detected=image_blank, detections=DetectionSet.empty()
+        )
+        time_s: float = time.time()
+        await self.describe_image(image, DetectionSet.empty())
+        time_delta: float = time.time() - time_s
+
+        logger.info(f"Warmed up the image describer in {time_delta:.2f} seconds")
+        return time_delta
+
 
 class DummyImageDescriber(ImageDescriber):
     def __init__(self):
         super().__init__(max_w_h=128)
 
-    async def describe_image(self, image: ImageObjectDetected) -> str:
+    async def describe_image(self, image: ImageObjectDetected, new_detections: DetectionSet) -> str:
+        self.model_calls += 1
         await asyncio.sleep(3)
         return "A dummy description"
+
+
+def create_image_describer(
+        backend: str, mode: str = "scene", multi_image: bool = False, max_batch: int = 1
+) -> ImageDescriber:
+    """
+    Create an image describer by name. Heavy backends are imported only when they are selected.
+    :param backend: One of "dummy" or "ollama".
+    :param mode: What the Ollama describer sends, "scene" or "crops", see OllamaImageDescriber.
+    :param multi_image: Whether the Ollama model accepts several images per request.
+    :param max_batch: The maximum number of scenes the Ollama describer combines into one request.
+    :return: The image describer.
+    """
+    if backend == "dummy":
+        return DummyImageDescriber()
+    if backend == "ollama":
+        from image_analyzer.image_describer.ollama_image_describer import OllamaImageDescriber
+        return OllamaImageDescriber(mode, multi_image, max_batch)
+    raise ValueError(f"Unknown image describer backend: {backend}")
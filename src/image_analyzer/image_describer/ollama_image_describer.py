@@ -1,15 +1,20 @@
+import asyncio
 import base64
 import io
 import logging
-from collections import defaultdict
-from typing import Any
+import math
+import re
+from collections.abc import Sequence
+from dataclasses import dataclass
+from typing import Any, Optional
 
 import aiohttp
+import numpy as np
 from PIL import Image
-from aiohttp import ClientResponse
 
-from image_analyzer.image_describer.image_describer import ImageDescriber
-from image_analyzer.object_detector.object_detector import Detection, ImageObjectDetected
+from image_analyzer.image_describer.image_describer import ImageDescriber, base64encode
+from image_analyzer.object_detector.object_detector import Detection, DetectionSet, ImageObjectDetected, \
+    letterbox_to_image_box
 
 __all__ = ["base64encode", "OllamaImageDescriber"]
 
@@ -21,44 +26,71 @@ ollama_max_w_h: int = 224
 ollama_model: str = "knoopx/mobile-vlm:3b-fp16"
 
 
-def get_ollama_prompt(detections: list[Detection]) -> str:
-    detections_dict: defaultdict[str, int] = defaultdict(int)
-    for detection in detections:
-        detections_dict[detection.class_name] += 1
-
-    detections_str: str = ", ".join(detections_dict.keys())
+def get_ollama_prompt(detections: Sequence[Detection]) -> str:
+    detections_str: str = ", ".join(DetectionSet.from_detections(detections).class_counts.keys())
     ollama_prompt: str = f"Briefly describe the image focusing on {detections_str}."
     logger.info(f"Using OLLAMA prompt: {ollama_prompt}")
     return ollama_prompt
 
 
-def base64encode(image: Image.Image) -> str:
+def get_ollama_batch_prompt(detections_batch: list[DetectionSet]) -> str:
+    focus: list[str] = [
+        f"{i + 1}: {', '.join(detections.class_counts.keys())}"
+        for i, detections in enumerate(detections_batch)
+    ]
+    ollama_prompt: str = (
+        f"You are given {len(detections_batch)} images from different cameras. For each image, in order, "
+        f"write one line starting with its number and briefly describe it, focusing on: {'; '.join(focus)}."
+    )
+    logger.info(f"Using OLLAMA prompt: {ollama_prompt}")
+    return ollama_prompt
+
+
+def split_batch_response(response: str, batch_size: int) -> list[Optional[str]]:
     """
-    Encode an image as a base64 string.
-    :param image: The image to encode.
-    :return: The base64 string.
+    Split the numbered lines of a batch response. Images without a line get None: the whole response
+    describes the other users' scenes too and must never be handed to a single user.
     """
+    lines: dict[int, str] = {}
+    for line in response.splitlines():
+        match: Optional[re.Match] = re.match(r"^\W*(?:image\s*)?(\d+)\s*[:.)-]\s*(.+)$", line, re.IGNORECASE)
+        if match is not None:
+            lines.setdefault(int(match.group(1)), match.group(2).strip())
+    return [lines.get(i + 1) for i in range(batch_size)]
+
+
+def jpeg_base64encode(image: Image.Image) -> str:
     buffer = io.BytesIO()
-    image.save(buffer, format="PNG")
+    image.convert("RGB").save(buffer, format="JPEG", quality=90)
     return base64.b64encode(buffer.getvalue()).decode()
 
 
-async def query(image: Image.Image, detections: list[Detection]) -> str:
+async def query(image: Image.Image, detections: Sequence[Detection]) -> str:
     """
     Query the OLLAMA server with an image.
     :param image: The image to query.
     :param detections: The list of object detections in the image.
     :return: The response from the OLLAMA server.
     """
+    return await query_images(get_ollama_prompt(detections), [base64encode(image)])
+
+
+async def query_images(prompt: str, images: list[str]) -> str:
+    """
+    Query the OLLAMA server with a prompt and several images.
+    :param prompt: The prompt.
+    :param images: The base64 encoded images.
+    :return: The response from the OLLAMA server.
+    """
     async with aiohttp.ClientSession() as session:
-        response: ClientResponse = await session.post(ollama_addr, json={
+        async with session.post(ollama_addr, json={
             "model": ollama_model,
-            "prompt": get_ollama_prompt(detections),
+            "prompt": prompt,
             "stream": False,
-            "images": [base64encode(image)],
-        })
+            "images": images,
+        }) as response:
+            response_full: dict[str, Any] = await response.json()
 
-    response_full: dict[str, Any] = await response.json()
     logger.info(f"Response from ollama: {response_full}")
     assert 'response' in response_full, (
         f"Invalid response_full from OLLAMA: {response_full}"
@@ -66,10 +98,150 @@ async def query(image: Image.Image, detections: list[Detection]) -> str:
     return response_full['response']
 
 
+@dataclass
+class BatchItem:
+    image: Image.Image
+    detections: DetectionSet
+    future: asyncio.Future[str]
+
+
 class OllamaImageDescriber(ImageDescriber):
-    def __init__(self):
-        super().__init__(ollama_max_w_h)
+    """
+    Describe images with a VLM served by OLLAMA.
+
+    In "scene" mode the whole scene is downsized to ollama_max_w_h. In "crops" mode the describer
+    sends tight crops around the newly appeared objects at the native resolution of the VLM instead, so that
+    small objects are not reduced to a few pixels. The crops go as separate images if the model accepts
+    several images per request (multi_image), or tiled into a single image otherwise.
+
+    With max_batch > 1, which requires multi_image, the scenes of up to max_batch users that arrive within
+    batch_window seconds are combined into one request, one image per scene, and the numbered lines of the
+    response are split between them.
+    """
 
-    async def describe_image(self, image: ImageObjectDetected) -> str:
-        image_resized: Image.Image = self.preprocess(image.image)
-        return await query(image_resized, image.detections)
+    def __init__(
+            self, mode: str = "scene", multi_image: bool = False, max_batch: int = 1,
+            max_crops: int = 4, crop_context: float = 0.2, batch_window: float = 0.05
+    ):
+        assert mode in ["scene", "crops"], f"Unexpected mode: {mode}"
+        assert max_batch == 1 or multi_image, "Batching requires a model that accepts several images"
+        super().__init__(ollama_max_w_h, max_concurrent=max_batch)
+        self.mode: str = mode
+        self.multi_image: bool = multi_image
+        self.max_batch: int = max_batch
+        self.max_crops: int = max_crops
+        # Fraction of the box size added around each crop, the VLM needs a bit of context
+        self.crop_context: float = crop_context
+        self.batch_window: float = batch_window
+
+        self.batch: list[BatchItem] = []
+        self.flush_task: Optional[asyncio.Task] = None
+
+    async def query_images(self, prompt: str, images: list[str]) -> str:
+        self.model_calls += 1
+        return await query_images(prompt, images)
+
+    def get_crop(self, image: ImageObjectDetected, detection: Detection) -> Image.Image:
+        img_w, img_h = image.image.size
+        ymin, xmin, ymax, xmax = letterbox_to_image_box(detection.box, image.image.size, image.image_detected.size)
+        pad_y, pad_x = (ymax - ymin) * self.crop_context, (xmax - xmin) * self.crop_context
+        region: tuple[int, int, int, int] = (
+            int(max(xmin - pad_x, 0.) * img_w), int(max(ymin - pad_y, 0.) * img_h),
+            math.ceil(min(xmax + pad_x, 1.) * img_w), math.ceil(min(ymax + pad_y, 1.) * img_h)
+        )
+        region_image: Image.Image = image.image.crop(region)
+
+        # Scale the crop to the native resolution of the VLM, upscaling small objects
+        region_w, region_h = region_image.size
+        scale: float = self.max_w_h / max(region_w, region_h, 1)
+        return region_image.resize(
+            (max(int(region_w * scale), 1), max(int(region_h * scale), 1)), Image.Resampling.BICUBIC
+        )
+
+    def tile(self, crops: list[Image.Image]) -> Image.Image:
+        """
+        Tile the crops into a single image at the native resolution of the VLM.
+        """
+        cols: int = math.ceil(math.sqrt(len(crops)))
+        rows: int = math.ceil(len(crops) / cols)
+        cell: int = self.max_w_h // cols
+        tiled: Image.Image = Image.new("RGB", (cell * cols, cell * rows))
+        for i, crop in enumerate(crops):
+            cell_image: Image.Image = crop.copy()
+            cell_image.thumbnail((cell, cell), Image.Resampling.BICUBIC)
+            tiled.paste(cell_image, ((i % cols) * cell, (i // cols) * cell))
+        return tiled
+
+    def get_focus(self, image: ImageObjectDetected, new_detections: DetectionSet) -> DetectionSet:
+        # Objects that were already there were described before, fall back to all of them otherwise
+        detections: DetectionSet = new_detections if len(new_detections) else image.detections
+        return detections[np.argsort(-detections.scores, kind="stable")[:self.max_crops]]
+
+    async def describe_image(self, image: ImageObjectDetected, new_detections: DetectionSet) -> str:
+        focus: DetectionSet = self.get_focus(image, new_detections)
+        if self.mode == "scene" or not len(focus):
+            scene: Image.Image = self.preprocess(image.image)
+            if self.max_batch > 1:
+                return await self.enqueue(scene, image.detections)
+            return await self.query_images(get_ollama_prompt(image.detections), [base64encode(scene)])
+
+        crops: list[Image.Image] = [self.get_crop(image, detection) for detection in focus]
+        if self.max_batch > 1:
+            return await self.enqueue(self.tile(crops), focus)
+        if self.multi_image:
+            return await self.query_images(get_ollama_prompt(focus), [jpeg_base64encode(crop) for crop in crops])
+        return await self.query_images(get_ollama_prompt(focus), [jpeg_base64encode(self.tile(crops))])
+
+    async def enqueue(self, image: Image.Image, detections: DetectionSet) -> str:
+        future: asyncio.Future[str] = asyncio.get_running_loop().create_future()
+        self.batch.append(BatchItem(image=image, detections=detections, future=future))
+        if len(self.batch) == 1:
+            self.flush_task = asyncio.create_task(self.flush())
+        return await future
+
+    async def flush(self) -> None:
+        # Give the other users' scenes batch_window seconds to join the request
+        await asyncio.sleep(self.batch_window)
+        batch: list[BatchItem] = self.batch
+        self.batch = []
+
+        if len(batch) == 1:
+            await self.resolve(batch[0])
+            return
+
+        logger.info(f"Describing {len(batch)} scenes in one request")
+        try:
+            response: str = await self.query_images(
+                get_ollama_batch_prompt([item.detections for item in batch]),
+                [jpeg_base64encode(item.image) for item in batch]
+            )
+        except Exception as e:
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            return
+
+        unmatched: list[BatchItem] = []
+        for item, description in zip(batch, split_batch_response(response, len(batch))):
+            if description is None:
+                unmatched.append(item)
+            elif not item.future.done():
+                item.future.set_result(description)
+        if unmatched:
+            logger.warning(f"Batch response has no line for {len(unmatched)} scenes, describing them one at a time")
+            await asyncio.gather(*[self.resolve(item) for item in unmatched])
+
+    async def resolve(self, item: BatchItem) -> None:
+        """
+        Describe a single scene of a batch on its own.
+        """
+        try:
+            description: str = await self.query_images(
+                get_ollama_prompt(item.detections), [jpeg_base64encode(item.image)]
+            )
+        except Exception as e:
+            if not item.future.done():
+                item.future.set_exception(e)
+            return
+        if not item.future.done():
+            item.future.set_result(description)
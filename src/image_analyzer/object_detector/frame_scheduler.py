@@ -0,0 +1,103 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from logging import getLogger
+from typing import Optional
+
+from PIL import Image
+
+__all__ = ["Frame", "FrameScheduler", "ADMITTED", "EXPIRED", "SUPERSEDED"]
+
+logger = getLogger(__name__)
+
+# Outcomes of FrameScheduler.acquire
+ADMITTED: str = "admitted"
+EXPIRED: str = "expired"
+SUPERSEDED: str = "superseded"
+
+
+@dataclass(frozen=True)
+class Frame:
+    image: Image.Image
+    user: str
+    captured_at: float
+    deadline: float
+
+    def is_expired(self, now: Optional[float] = None) -> bool:
+        return (time.time() if now is None else now) > self.deadline
+
+
+class FrameScheduler:
+    """
+    Admits frames to the object detector one at a time, round-robin across users.
+
+    Each user has at most max_pending_per_user frames waiting; a newer frame supersedes the oldest one,
+    since a fresh frame is always worth more than an old one. Frames whose deadline has passed are
+    dropped before inference.
+    """
+
+    def __init__(self, max_pending_per_user: int = 1):
+        assert max_pending_per_user >= 1, f"Expected max_pending_per_user >= 1, got {max_pending_per_user}"
+        self.max_pending_per_user: int = max_pending_per_user
+        self.busy: bool = False
+        self.queues: OrderedDict[str, deque[tuple[Frame, asyncio.Future[str]]]] = OrderedDict()
+
+    def pending(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+    async def acquire(self, frame: Frame) -> str:
+        """
+        Wait until it is the frame's turn to use the object detector.
+        :param frame: The frame to schedule.
+        :return: ADMITTED if the caller now holds the object detector and must call release,
+                 EXPIRED or SUPERSEDED if the frame must be dropped.
+        """
+        if frame.is_expired():
+            logger.info(f"Dropping expired frame for user {frame.user}")
+            return EXPIRED
+
+        if not self.busy and not self.queues:
+            self.busy = True
+            return ADMITTED
+
+        future: asyncio.Future[str] = asyncio.get_running_loop().create_future()
+        queue: deque[tuple[Frame, asyncio.Future[str]]] = self.queues.setdefault(frame.user, deque())
+        queue.append((frame, future))
+        if len(queue) > self.max_pending_per_user:
+            _, superseded = queue.popleft()
+            if not superseded.done():
+                superseded.set_result(SUPERSEDED)
+            logger.info(f"Superseded a pending frame for user {frame.user}")
+
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # The turn may have been handed over right before the cancellation
+            if future.done() and not future.cancelled() and future.result() == ADMITTED:
+                self.release()
+            raise
+
+    def release(self) -> None:
+        """
+        Hand the object detector over to the next user in round-robin order, dropping expired frames.
+        """
+        now: float = time.time()
+        while self.queues:
+            user, queue = self.queues.popitem(last=False)
+            frame, future = queue.popleft()
+            if queue:
+                # The user goes to the back of the line
+                self.queues[user] = queue
+
+            if future.done():
+                continue
+            if frame.is_expired(now):
+                logger.info(f"Dropping expired frame for user {user}")
+                future.set_result(EXPIRED)
+                continue
+
+            future.set_result(ADMITTED)
+            return
+
+        self.busy = False
@@ -13,12 +13,25 @@ logger = getLogger(__name__)
 IMAGE_EXTENSIONS: Tuple[str, ...] = ('.jpg', '.png', '.bmp', '.jpeg')
 
 
+def create_vdevice() -> VDevice:
+    """
+    Create a virtual device with the scheduler activated, so that several models can share it.
+
+    Returns:
+        VDevice: The virtual device.
+    """
+    params = VDevice.create_params()
+    # Set the scheduling algorithm to round-robin to activate the scheduler
+    params.scheduling_algorithm = HailoSchedulingAlgorithm.ROUND_ROBIN
+    return VDevice(params)
+
+
 class HailoAsyncInference:
     def __init__(
             self, hef_path: str, input_queue: queue.Queue,
             output_queue: queue.Queue, batch_size: int = 1,
             input_type: Optional[str] = None, output_type: Optional[Dict[str, str]] = None,
-            send_original_frame: bool = False) -> None:
+            send_original_frame: bool = False, target: Optional[VDevice] = None) -> None:
         """
         Initialize the HailoAsyncInference class with the provided HEF model
         file path and input/output queues.
@@ -33,15 +46,14 @@ class HailoAsyncInference:
                                         Possible values: 'UINT8', 'UINT16'.
             output_type Optional[dict[str, str]] : Format type of the output stream.
                                          Possible values: 'UINT8', 'UINT16', 'FLOAT32'.
+            target (Optional[VDevice]): Virtual device to run on, shared by several
+                                        models. Defaults to a new one.
         """
         self.input_queue = input_queue
         self.output_queue = output_queue
-        params = VDevice.create_params()
-        # Set the scheduling algorithm to round-robin to activate the scheduler
-        params.scheduling_algorithm = HailoSchedulingAlgorithm.ROUND_ROBIN
 
         self.hef = HEF(hef_path)
-        self.target = VDevice(params)
+        self.target = target if target is not None else create_vdevice()
         self.infer_model = self.target.create_infer_model(hef_path)
         self.infer_model.set_batch_size(batch_size)
         if input_type is not None:
@@ -7,9 +7,10 @@ from typing import Any, Optional
 
 import numpy as np
 from PIL import Image
+from hailo_platform import VDevice
 
-from image_analyzer.object_detector.hailo_async_interface import HailoAsyncInference
-from image_analyzer.object_detector.object_detector import Detection, ObjectDetector
+from image_analyzer.object_detector.hailo_async_interface import HailoAsyncInference, create_vdevice
+from image_analyzer.object_detector.object_detector import DetectionSet, ObjectDetector
 
 __all__ = ["HailoObjectDetector"]
 
@@ -31,15 +32,22 @@ def get_labels(labels_path: Path) -> list[str]:
     return class_names
 
 
-class HailoObjectDetector(ObjectDetector):
-    def __init__(self):
-        self.model_path: Path = (Path(__file__).parent / "yolov10b.hef").resolve()
-        self.w, self.h = 640, 640
-        self.threshold: float = 0.5
-        super().__init__(self.w, self.h)
+vdevice: Optional[VDevice] = None
 
-        self.labels_path: Path = (Path(__file__).parent / "coco.txt").resolve()
-        self.labels: list[str] = get_labels(self.labels_path)
+
+def get_vdevice() -> VDevice:
+    """
+    Get the virtual device shared by all the models of the process, e.g. the two passes of a cascade.
+    """
+    global vdevice
+    if vdevice is None:
+        vdevice = create_vdevice()
+    return vdevice
+
+
+class HailoObjectDetector(ObjectDetector):
+    def __init__(self, model_name: str = "yolov10b.hef", threshold: float = 0.5):
+        self.model_path: Path = (Path(__file__).parent / model_name).resolve()
 
         # We only allow one item in the queue at a time
         # This is to ensure that the outputs are not mixed up
@@ -48,31 +56,35 @@ class HailoObjectDetector(ObjectDetector):
         self.output_queue: Queue[tuple[Any, list[Any]]] = Queue()
         hailo_async_inference: HailoAsyncInference = HailoAsyncInference(
             str(self.model_path),
-            self.input_queue, self.output_queue, batch_size=1
+            self.input_queue, self.output_queue, batch_size=1, target=get_vdevice()
         )
+
+        # The input resolution comes from the model, e.g. 640x640 for yolov10b
+        self.h, self.w, _ = hailo_async_inference.get_input_shape()
+        super().__init__(self.w, self.h, threshold)
+
+        self.labels_path: Path = (Path(__file__).parent / "coco.txt").resolve()
+        self.labels: list[str] = get_labels(self.labels_path)
+
         threading.Thread(target=hailo_async_inference.run, daemon=True).start()
 
-    def extract_detections(self, outputs: list[np.ndarray]) -> list[Detection]:
-        detections: list[Detection] = []
+    def extract_detections(self, outputs: list[np.ndarray]) -> DetectionSet:
+        boxes: list[np.ndarray] = []
+        scores: list[np.ndarray] = []
+        class_ids: list[np.ndarray] = []
         for i, output in enumerate(outputs):
             assert len(output.shape) == 2, f"Expected 2 dimensions in output, got {output.shape}"
-            for det in output:
-                bbox, score = det[:4].tolist(), det[4].item()
-                if score < self.threshold:
-                    continue
-
-                assert len(bbox) == 4, f"Expected 4 values in bbox, got {bbox}"
-                bbox_t: tuple[float, float, float, float] = tuple(bbox)
-                detections.append(Detection(
-                    box=bbox_t,
-                    score=score,
-                    class_id=i,
-                    class_name=self.labels[i]
-                ))
-
-        return detections
-
-    async def run(self, image_preprocessed: Image.Image) -> list[Detection]:
+            # Each row is (ymin, xmin, ymax, xmax, score)
+            output = output[output[:, 4] >= self.threshold]
+            boxes.append(output[:, :4])
+            scores.append(output[:, 4])
+            class_ids.append(np.full(len(output), i, dtype=np.uint16))
+
+        if not boxes:
+            return DetectionSet.empty()
+        return DetectionSet(np.concatenate(boxes), np.concatenate(scores), np.concatenate(class_ids), self.labels)
+
+    async def run(self, image_preprocessed: Image.Image) -> DetectionSet:
         async with self.lock:
             self.input_queue.put([image_preprocessed])
             # We put a single image, so we expect a single output
@@ -84,5 +96,5 @@ class HailoObjectDetector(ObjectDetector):
             outputs = outputs[0]
         return self.extract_detections(outputs)
 
-    async def detect_objects(self, image_preprocessed: Image.Image) -> list[Detection]:
+    async def detect_objects(self, image_preprocessed: Image.Image) -> DetectionSet:
         return await self.run(image_preprocessed)
@@ -1,20 +1,27 @@
 import asyncio
+import time
 from abc import ABC, abstractmethod
-from collections import defaultdict
+from collections.abc import Iterable, Mapping, Sequence
 from dataclasses import dataclass
 from logging import getLogger
-from typing import final
+from typing import Optional, Union, final, overload
 
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 from numpy.random import default_rng
 
-__all__ = ["Detection", "ImageObjectDetected", "ObjectDetector", "DummyObjectDetector", "detections_to_str"]
+from image_analyzer.tracing import span
+
+__all__ = [
+    "Detection", "DetectionSet", "ImageObjectDetected", "ObjectDetector", "DummyObjectDetector",
+    "detections_to_str", "detections_to_arrays", "letterbox_to_image_box", "letterbox_to_image_boxes",
+    "CascadeObjectDetector", "create_object_detector"
+]
 
 logger = getLogger(__name__)
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class Detection:
     box: tuple[float, float, float, float]
     score: float
@@ -22,19 +29,159 @@ class Detection:
     class_name: str
 
 
-@dataclass(frozen=True)
+class DetectionSet(Sequence[Detection]):
+    """
+    The detections of a frame, stored as arrays of boxes, scores and class ids.
+
+    The class counts are computed once per frame and shared by change detection, prompt building
+    and response formatting. Indexing builds Detection records on demand.
+    """
+    __slots__ = ("boxes", "scores", "class_ids", "names", "_class_counts", "_signature")
+
+    def __init__(
+            self, boxes: np.ndarray, scores: np.ndarray, class_ids: np.ndarray,
+            names: Union[Sequence[str], Mapping[int, str]]
+    ):
+        """
+        :param boxes: The boxes (ymin, xmin, ymax, xmax), shape (n, 4).
+        :param scores: The scores, shape (n,).
+        :param class_ids: The class ids, shape (n,).
+        :param names: The class names by class id, e.g. the labels of the detector.
+        """
+        assert boxes.shape == (len(scores), 4) and class_ids.shape == scores.shape, (
+            f"Mismatched shapes: boxes {boxes.shape}, scores {scores.shape}, class_ids {class_ids.shape}"
+        )
+        # The detectors output float32, and the class ids of the models fit in 16 bits
+        self.boxes: np.ndarray = boxes.astype(np.float32, copy=False)
+        self.scores: np.ndarray = scores.astype(np.float32, copy=False)
+        self.class_ids: np.ndarray = class_ids.astype(np.uint16, copy=False)
+        self.names: Union[Sequence[str], Mapping[int, str]] = names
+        self._class_counts: Optional[dict[str, int]] = None
+        self._signature: Optional[frozenset[tuple[str, int]]] = None
+
+    @classmethod
+    def empty(cls) -> "DetectionSet":
+        return cls(np.empty((0, 4), dtype=np.float32), np.empty(0, dtype=np.float32), np.empty(0, dtype=np.uint16), {})
+
+    @classmethod
+    def from_detections(cls, detections: Iterable[Detection]) -> "DetectionSet":
+        if isinstance(detections, DetectionSet):
+            return detections
+        detections = list(detections)
+        return cls(
+            np.array([detection.box for detection in detections], dtype=np.float32).reshape(-1, 4),
+            np.array([detection.score for detection in detections], dtype=np.float32),
+            np.array([detection.class_id for detection in detections], dtype=np.uint16),
+            {detection.class_id: detection.class_name for detection in detections}
+        )
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    @overload
+    def __getitem__(self, index: int) -> Detection:
+        ...
+
+    @overload
+    def __getitem__(self, index: Union[slice, np.ndarray]) -> "DetectionSet":
+        ...
+
+    def __getitem__(self, index: Union[int, slice, np.ndarray]) -> Union[Detection, "DetectionSet"]:
+        # Slices and boolean masks select a subset of the detections
+        if isinstance(index, (slice, np.ndarray)):
+            return DetectionSet(self.boxes[index], self.scores[index], self.class_ids[index], self.names)
+        ymin, xmin, ymax, xmax = self.boxes[index].tolist()
+        class_id: int = int(self.class_ids[index])
+        return Detection(
+            box=(ymin, xmin, ymax, xmax), score=float(self.scores[index]),
+            class_id=class_id, class_name=self.names[class_id]
+        )
+
+    def __repr__(self) -> str:
+        # Logged for every frame, so it summarizes the cached class counts instead of building each Detection
+        return f"DetectionSet({len(self)} detections, {self.class_counts})"
+
+    def with_boxes(self, boxes: np.ndarray) -> "DetectionSet":
+        return DetectionSet(boxes, self.scores, self.class_ids, self.names)
+
+    @property
+    def class_counts(self) -> dict[str, int]:
+        """
+        The number of detections of each class, in the order the classes first appear.
+        """
+        if self._class_counts is None:
+            class_ids, first, counts = np.unique(self.class_ids, return_index=True, return_counts=True)
+            class_counts: dict[str, int] = {}
+            for i in np.argsort(first).tolist():
+                class_name: str = self.names[int(class_ids[i])]
+                class_counts[class_name] = class_counts.get(class_name, 0) + int(counts[i])
+            self._class_counts = class_counts
+        return self._class_counts
+
+    @property
+    def signature(self) -> frozenset[tuple[str, int]]:
+        """
+        The class counts as a hashable value, two frames with the same signature show the same objects.
+        """
+        if self._signature is None:
+            self._signature = frozenset(self.class_counts.items())
+        return self._signature
+
+
+@dataclass(frozen=True, slots=True)
 class ImageObjectDetected:
     image: Image.Image
     image_detected: Image.Image
-    detections: list[Detection]
+    detections: DetectionSet
 
 
-def detections_to_str(detections: list[Detection]) -> str:
-    detections_dict: defaultdict[str, int] = defaultdict(int)
-    for detection in detections:
-        detections_dict[detection.class_name] += 1
+def detections_to_str(detections: Sequence[Detection]) -> str:
+    class_counts: dict[str, int] = DetectionSet.from_detections(detections).class_counts
+    return "\n".join([f"{class_name}: {count}" for class_name, count in class_counts.items()])
+
+
+def detections_to_arrays(detections: Sequence[Detection]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Convert detections to compact arrays.
+    :param detections: The detections to convert.
+    :return: The boxes (float32, shape (n, 4)), scores (float32, shape (n,)) and class ids (uint16, shape (n,)).
+    """
+    detection_set: DetectionSet = DetectionSet.from_detections(detections)
+    return detection_set.boxes, detection_set.scores, detection_set.class_ids
+
+
+def letterbox_to_image_boxes(
+        boxes: np.ndarray, image_size: tuple[int, int], letterbox_size: tuple[int, int]
+) -> np.ndarray:
+    """
+    Map boxes normalized to a letterboxed image, as made by ObjectDetector.preprocess, back to the original image.
+    :param boxes: The boxes (ymin, xmin, ymax, xmax) normalized to the letterboxed image, shape (n, 4).
+    :param image_size: The (width, height) of the original image.
+    :param letterbox_size: The (width, height) of the letterboxed image.
+    :return: The boxes (ymin, xmin, ymax, xmax) normalized to the original image, clipped to [0, 1].
+    """
+    img_w, img_h = image_size
+    p_w, p_h = letterbox_size
+    scale: float = min(p_w / img_w, p_h / img_h)
+    new_img_w, new_img_h = int(img_w * scale), int(img_h * scale)
+    pad_x, pad_y = (p_w - new_img_w) // 2, (p_h - new_img_h) // 2
+
+    size: np.ndarray = np.array([p_h, p_w, p_h, p_w], dtype=np.float64)
+    pad: np.ndarray = np.array([pad_y, pad_x, pad_y, pad_x], dtype=np.float64)
+    new_size: np.ndarray = np.array([new_img_h, new_img_w, new_img_h, new_img_w], dtype=np.float64)
+    return np.clip((boxes * size - pad) / new_size, 0., 1.)
 
-    return "\n".join([f"{class_name}: {count}" for class_name, count in detections_dict.items()])
+
+def letterbox_to_image_box(
+        box: tuple[float, float, float, float], image_size: tuple[int, int], letterbox_size: tuple[int, int]
+) -> tuple[float, float, float, float]:
+    """
+    Map a single box, see letterbox_to_image_boxes.
+    """
+    ymin, xmin, ymax, xmax = letterbox_to_image_boxes(
+        np.array([box], dtype=np.float64), image_size, letterbox_size
+    )[0].tolist()
+    return ymin, xmin, ymax, xmax
 
 
 def class_id_to_color(class_id: int) -> tuple[int, int, int]:
@@ -58,7 +205,7 @@ def draw_detection(
     draw.text((xmin + 4, ymin + 4), label, fill=color, font=font)
 
 
-def draw_detections(image_detected: Image.Image, detections: list[Detection]) -> None:
+def draw_detections(image_detected: Image.Image, detections: Sequence[Detection]) -> None:
     draw: ImageDraw.Draw = ImageDraw.Draw(image_detected)
     height, width = image_detected.size
     for detection in detections:
@@ -69,9 +216,11 @@ def draw_detections(image_detected: Image.Image, detections: list[Detection]) ->
 
 
 class ObjectDetector(ABC):
-    def __init__(self, preprocess_width: int, preprocess_height: int):
+    def __init__(self, preprocess_width: int, preprocess_height: int, threshold: float = 0.5):
         self.preprocess_width: int = preprocess_width
         self.preprocess_height: int = preprocess_height
+        # Detections scoring below threshold are discarded
+        self.threshold: float = threshold
         self.padding_color: tuple[int, int, int] = (114, 114, 114)
 
     @final
@@ -89,27 +238,90 @@ class ObjectDetector(ABC):
         padded_image.paste(image_resized, ((p_w - new_img_w) // 2, (p_h - new_img_h) // 2))
         return padded_image
 
+    @final
+    def to_image_box(
+            self, box: tuple[float, float, float, float], image_size: tuple[int, int]
+    ) -> tuple[float, float, float, float]:
+        """
+        Map a box normalized to the letterboxed detector input back to the original image.
+        :param box: The box (ymin, xmin, ymax, xmax) normalized to the preprocessed image.
+        :param image_size: The (width, height) of the original image.
+        :return: The box (ymin, xmin, ymax, xmax) normalized to the original image, clipped to [0, 1].
+        """
+        return letterbox_to_image_box(box, image_size, (self.preprocess_width, self.preprocess_height))
+
+    @final
+    def to_image_boxes(self, detections: DetectionSet, image_size: tuple[int, int]) -> DetectionSet:
+        """
+        Map the boxes of the detections back to the original image, see to_image_box.
+        """
+        return detections.with_boxes(letterbox_to_image_boxes(
+            detections.boxes, image_size, (self.preprocess_width, self.preprocess_height)
+        ))
+
     @abstractmethod
-    async def detect_objects(self, image_preprocessed: Image.Image) -> list[Detection]:
+    async def detect_objects(self, image_preprocessed: Image.Image) -> Sequence[Detection]:
         pass
 
+    async def warm_up_objects(self, image_preprocessed: Image.Image) -> None:
+        """
+        Run a warm-up inference. Detectors made of several models override this to warm all of them up.
+        """
+        await self.detect_objects(image_preprocessed)
+
     @final
     async def detect(self, image: Image.Image) -> ImageObjectDetected:
-        image_detected: Image.Image = self.preprocess(image)
-        detections: list[Detection] = await self.detect_objects(image_detected)
-        draw_detections(image_detected, detections)
+        with span("preprocess"):
+            image_detected: Image.Image = self.preprocess(image)
+        with span("inference"):
+            detections: DetectionSet = DetectionSet.from_detections(await self.detect_objects(image_detected))
+        with span("draw"):
+            draw_detections(image_detected, detections)
         logger.info(f"Detected {len(detections)} objects in the image, detections: {detections}")
 
         return ImageObjectDetected(
             image=image, image_detected=image_detected, detections=detections
         )
 
+    @final
+    async def detect_boxes(self, image: Image.Image) -> DetectionSet:
+        """
+        Detect objects without drawing them.
+        :param image: The image to detect objects in.
+        :return: The detections, with boxes normalized to the original image.
+        """
+        with span("preprocess"):
+            image_preprocessed: Image.Image = self.preprocess(image)
+        with span("inference"):
+            detections: DetectionSet = DetectionSet.from_detections(await self.detect_objects(image_preprocessed))
+        return self.to_image_boxes(detections, image.size)
+
+    @final
+    async def warm_up(self, iterations: int) -> list[float]:
+        """
+        Run inferences on a blank frame so that the first real request does not pay for
+        model loading and device configuration.
+        :param iterations: The number of warm-up inferences to run.
+        :return: The duration of each warm-up inference in seconds.
+        """
+        image_blank: Image.Image = Image.new(
+            'RGB', (self.preprocess_width, self.preprocess_height), self.padding_color
+        )
+        times: list[float] = []
+        for _ in range(iterations):
+            time_s: float = time.time()
+            await self.warm_up_objects(image_blank)
+            times.append(time.time() - time_s)
+
+        logger.info(f"Warmed up the object detector, times: {times}")
+        return times
+
 
 class DummyObjectDetector(ObjectDetector):
     def __init__(self):
         super().__init__(preprocess_width=300, preprocess_height=300)
 
-    async def detect_objects(self, image_preprocessed: Image.Image) -> list[Detection]:
+    async def detect_objects(self, image_preprocessed: Image.Image) -> Sequence[Detection]:
         await asyncio.sleep(0.1)
         return [
             Detection(
@@ -119,3 +331,81 @@ class DummyObjectDetector(ObjectDetector):
                 class_name="dummy"
             )
         ]
+
+
+class CascadeObjectDetector(ObjectDetector):
+    """
+    Run a cheap detector first, a smaller model or a lower input resolution, and escalate to the full
+    detector only when the cheap pass calls for it. Most frames are empty and never reach the full detector.
+
+    The cheap detector should use a threshold of full.threshold - margin, so that it reports the candidates
+    the policies look at. With the "candidates" escalation, any candidate escalates the frame. With the
+    "ambiguous" escalation, only candidates scoring within margin of the threshold escalate the frame,
+    and the confident detections of the cheap pass are returned as they are.
+    """
+
+    def __init__(
+            self, cheap: ObjectDetector, full: ObjectDetector, escalation: str = "candidates", margin: float = 0.15
+    ):
+        assert escalation in ["candidates", "ambiguous"], f"Unexpected escalation: {escalation}"
+        super().__init__(full.preprocess_width, full.preprocess_height, full.threshold)
+        self.cheap: ObjectDetector = cheap
+        self.full: ObjectDetector = full
+        self.escalation: str = escalation
+        self.margin: float = margin
+        self.frames: int = 0
+        self.escalations: int = 0
+
+    def should_escalate(self, candidates: DetectionSet) -> bool:
+        low, high = self.threshold - self.margin, self.threshold + self.margin
+        if self.escalation == "candidates":
+            return bool(np.any(candidates.scores >= low))
+        return bool(np.any((candidates.scores >= low) & (candidates.scores < high)))
+
+    async def detect_objects(self, image_preprocessed: Image.Image) -> Sequence[Detection]:
+        self.frames += 1
+        with span("cascade_cheap"):
+            # The cheap detector letterboxes the already letterboxed frame, so its boxes are mapped back
+            image_cheap: Image.Image = self.cheap.preprocess(image_preprocessed)
+            candidates: DetectionSet = DetectionSet.from_detections(await self.cheap.detect_objects(image_cheap))
+
+        if self.should_escalate(candidates):
+            self.escalations += 1
+            logger.info(f"Escalating to the full detector, escalated {self.escalations} of {self.frames} frames")
+            with span("cascade_full"):
+                return await self.full.detect_objects(image_preprocessed)
+
+        return self.cheap.to_image_boxes(candidates[candidates.scores >= self.threshold], image_preprocessed.size)
+
+    async def warm_up_objects(self, image_preprocessed: Image.Image) -> None:
+        await self.cheap.warm_up_objects(self.cheap.preprocess(image_preprocessed))
+        await self.full.warm_up_objects(image_preprocessed)
+
+
+def create_object_detector(
+        backend: str, cheap_model: Optional[str] = None, escalation: str = "candidates", margin: float = 0.15
+) -> ObjectDetector:
+    """
+    Create an object detector by name. Heavy backends are imported only when they are selected.
+    :param backend: One of "dummy" or "hailo".
+    :param cheap_model: The HEF file of the cheap pass of a CascadeObjectDetector, None disables the cascade.
+    :param escalation: The escalation policy of the cascade, "candidates" or "ambiguous".
+    :param margin: The confidence margin around the threshold of the cascade.
+    :return: The object detector.
+    :raises ValueError: If the backend is unknown, the escalation policy is unknown,
+                        or a cascade is requested from a backend that does not support it.
+    """
+    if escalation not in ["candidates", "ambiguous"]:
+        raise ValueError(f"Unknown cascade escalation: {escalation}")
+    if backend == "dummy":
+        if cheap_model is not None:
+            raise ValueError(f"The {backend} object detector backend does not support a cascade")
+        return DummyObjectDetector()
+    if backend == "hailo":
+        from image_analyzer.object_detector.hailo_object_detector import HailoObjectDetector
+        full: ObjectDetector = HailoObjectDetector()
+        if cheap_model is None:
+            return full
+        cheap: ObjectDetector = HailoObjectDetector(cheap_model, threshold=full.threshold - margin)
+        return CascadeObjectDetector(cheap, full, escalation, margin)
+    raise ValueError(f"Unknown object detector backend: {backend}")
@@ -0,0 +1,181 @@
+import asyncio
+import io
+import struct
+from dataclasses import dataclass
+from logging import getLogger
+from pathlib import Path
+from typing import BinaryIO, Iterator, Optional
+
+from PIL import Image
+
+__all__ = ["Record", "RecordEntry", "Recorder", "read_index", "read_records"]
+
+logger = getLogger(__name__)
+
+# Each record is a header (arrival time, user length, image length) followed by the user and a JPEG image
+record_header: struct.Struct = struct.Struct("<dHI")
+segment_suffix: str = ".rec"
+
+
+@dataclass(frozen=True)
+class Record:
+    arrival: float
+    user: str
+    image: Image.Image
+
+
+def segment_paths(archive_dir: Path) -> list[Path]:
+    # Segment names are zero-padded sequence numbers, so the lexicographic order is the recording order
+    return sorted(archive_dir.glob(f"*{segment_suffix}"))
+
+
+@dataclass(frozen=True)
+class RecordEntry:
+    """
+    The header of a record and where its image is, without the decoded image.
+    """
+    arrival: float
+    user: str
+    path: Path
+    offset: int
+    length: int
+
+    def load(self) -> Record:
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            image: Image.Image = Image.open(io.BytesIO(f.read(self.length)))
+            image.load()
+        return Record(arrival=self.arrival, user=self.user, image=image)
+
+
+def read_index(archive_dir: Path) -> Iterator[RecordEntry]:
+    """
+    Read the headers of the records of an archive in recording order, skipping over the images.
+    :param archive_dir: The directory the Recorder wrote to.
+    :return: The record entries, load them to decode the images.
+    """
+    for path in segment_paths(archive_dir):
+        size: int = path.stat().st_size
+        with open(path, "rb") as f:
+            while header := f.read(record_header.size):
+                if len(header) < record_header.size:
+                    logger.warning(f"Truncated record header in {path}")
+                    break
+                arrival, user_len, image_len = record_header.unpack(header)
+                user: bytes = f.read(user_len)
+                offset: int = f.tell()
+                if len(user) < user_len or offset + image_len > size:
+                    logger.warning(f"Truncated record in {path}")
+                    break
+                f.seek(image_len, io.SEEK_CUR)
+                yield RecordEntry(arrival=arrival, user=user.decode(), path=path, offset=offset, length=image_len)
+
+
+def read_records(archive_dir: Path) -> Iterator[Record]:
+    """
+    Read the records of an archive in recording order.
+    :param archive_dir: The directory the Recorder wrote to.
+    :return: The records, with the images decoded one at a time.
+    """
+    for entry in read_index(archive_dir):
+        yield entry.load()
+
+
+class Recorder:
+    """
+    Record incoming frames to segment files in archive_dir, for replaying them later.
+
+    Frames are optionally downscaled to max_w_h and JPEG encoded off the request path, by a single writer
+    that takes them in arrival order. Frames are dropped with a warning if max_buffered of them are waiting.
+    The archive is bounded: once it exceeds max_bytes, the oldest segments are deleted.
+    """
+
+    def __init__(
+            self, archive_dir: Path, max_bytes: int = 1 << 30, max_w_h: Optional[int] = None, quality: int = 90,
+            max_buffered: int = 64
+    ):
+        self.archive_dir: Path = archive_dir
+        self.max_bytes: int = max_bytes
+        self.segment_bytes: int = max(max_bytes // 8, 1)
+        self.max_w_h: Optional[int] = max_w_h
+        self.quality: int = quality
+        archive_dir.mkdir(parents=True, exist_ok=True)
+
+        self.queue: asyncio.Queue[tuple[str, Image.Image, float]] = asyncio.Queue(maxsize=max_buffered)
+        self.writer: Optional[asyncio.Task] = None
+        existing: list[Path] = segment_paths(archive_dir)
+        self.segment_index: int = int(existing[-1].stem) + 1 if existing else 0
+        self.segment: Optional[BinaryIO] = None
+        self.segment_size: int = 0
+
+    def record(self, user: str, image: Image.Image, arrival: float) -> None:
+        """
+        Record a frame in the background.
+        """
+        if self.writer is None:
+            self.writer = asyncio.create_task(self.write_loop())
+        try:
+            self.queue.put_nowait((user, image, arrival))
+        except asyncio.QueueFull:
+            logger.warning(f"Recorder buffer is full, dropping frame for user {user}")
+
+    async def write_loop(self) -> None:
+        while True:
+            user, image, arrival = await self.queue.get()
+            try:
+                await asyncio.to_thread(self.write, user, image, arrival)
+            except OSError:
+                logger.exception(f"Failed to record frame for user {user}")
+            finally:
+                self.queue.task_done()
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            await self.queue.join()
+            self.writer.cancel()
+            try:
+                await self.writer
+            except asyncio.CancelledError:
+                pass
+            self.writer = None
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+
+    def encode(self, image: Image.Image) -> bytes:
+        if self.max_w_h is not None and max(image.size) > self.max_w_h:
+            scale: float = self.max_w_h / max(image.size)
+            image = image.resize(
+                (max(int(image.width * scale), 1), max(int(image.height * scale), 1)), Image.Resampling.BILINEAR
+            )
+        buffer = io.BytesIO()
+        image.convert("RGB").save(buffer, format="JPEG", quality=self.quality)
+        return buffer.getvalue()
+
+    def write(self, user: str, image: Image.Image, arrival: float) -> None:
+        user_bytes: bytes = user.encode()
+        image_bytes: bytes = self.encode(image)
+        data: bytes = record_header.pack(arrival, len(user_bytes), len(image_bytes)) + user_bytes + image_bytes
+
+        if self.segment is None or self.segment_size >= self.segment_bytes:
+            self.rotate()
+        self.segment.write(data)
+        self.segment.flush()
+        self.segment_size += len(data)
+
+    def rotate(self) -> None:
+        if self.segment is not None:
+            self.segment.close()
+        self.segment = open(self.archive_dir / f"{self.segment_index:08d}{segment_suffix}", "wb")
+        self.segment_index += 1
+        self.segment_size = 0
+
+        segments: list[Path] = segment_paths(self.archive_dir)
+        total: int = sum(path.stat().st_size for path in segments)
+        # Never delete the segment that was just opened
+        for path in segments[:-1]:
+            if total <= self.max_bytes:
+                break
+            total -= path.stat().st_size
+            path.unlink()
+            logger.info(f"Deleted segment {path} to keep the archive under {self.max_bytes} bytes")
@@ -0,0 +1,128 @@
+import cProfile
+import logging
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from logging import getLogger
+from pathlib import Path
+from typing import Iterator, Optional
+
+__all__ = ["Trace", "trace", "span", "get_timings", "RequestIdFilter", "SamplingProfiler"]
+
+logger = getLogger(__name__)
+
+trace_var: ContextVar[Optional["Trace"]] = ContextVar("trace", default=None)
+# Request ids taken from the clients must match this, they end up in the logs and the response headers
+request_id_pattern: re.Pattern = re.compile(r"[A-Za-z0-9-]{1,64}")
+
+
+@dataclass
+class Trace:
+    request_id: str
+    # Accumulated duration of each stage in seconds, in the order the stages started
+    timings: dict[str, float] = field(default_factory=dict)
+
+    def server_timing(self) -> str:
+        """
+        Format the timings as a Server-Timing header value, durations in milliseconds.
+        """
+        return ", ".join(f"{name};dur={duration * 1000:.1f}" for name, duration in self.timings.items())
+
+
+@contextmanager
+def trace(request_id: Optional[str] = None) -> Iterator[Trace]:
+    """
+    Start a trace for the current task, or join the trace that is already active.
+    The trace is carried to the callees through a context variable, including asyncio.to_thread calls.
+    :param request_id: The request id, a new one is generated if it is missing or does not match request_id_pattern.
+    """
+    current: Optional[Trace] = trace_var.get()
+    if current is not None:
+        yield current
+        return
+
+    if request_id is None or not request_id_pattern.fullmatch(request_id):
+        request_id = uuid.uuid4().hex[:16]
+    new_trace: Trace = Trace(request_id=request_id)
+    token = trace_var.set(new_trace)
+    try:
+        yield new_trace
+    finally:
+        trace_var.reset(token)
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """
+    Add the duration of the block to the stage name of the active trace, if any.
+    """
+    time_s: float = time.time()
+    try:
+        yield
+    finally:
+        current: Optional[Trace] = trace_var.get()
+        if current is not None:
+            current.timings[name] = current.timings.get(name, 0.) + time.time() - time_s
+
+
+def get_timings() -> dict[str, float]:
+    current: Optional[Trace] = trace_var.get()
+    return dict(current.timings) if current is not None else {}
+
+
+class RequestIdFilter(logging.Filter):
+    """
+    Add the request id of the active trace to the log records, "-" outside of a trace.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        current: Optional[Trace] = trace_var.get()
+        record.request_id = current.request_id if current is not None else "-"
+        return True
+
+
+class SamplingProfiler:
+    """
+    Profile one in every_n requests with cProfile and dump the profiles of the sampled requests
+    slower than min_duration to out_dir, as numbered pstats files. The log line of each dump names its request id.
+
+    Only one request is profiled at a time, since cProfile profiles the whole thread; the profile of
+    a request therefore also contains the work of the requests interleaved with it on the event loop.
+    """
+
+    def __init__(self, out_dir: Path, every_n: int, min_duration: float = 0.):
+        assert every_n >= 1, f"Expected every_n >= 1, got {every_n}"
+        self.out_dir: Path = out_dir
+        self.every_n: int = every_n
+        self.min_duration: float = min_duration
+        self.requests: int = 0
+        self.dumps: int = 0
+        self.active: bool = False
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def profile(self, request_id: str) -> Iterator[None]:
+        self.requests += 1
+        if self.active or self.requests % self.every_n != 0:
+            yield
+            return
+
+        self.active = True
+        profiler: cProfile.Profile = cProfile.Profile()
+        time_s: float = time.time()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self.active = False
+            time_delta: float = time.time() - time_s
+            if time_delta >= self.min_duration:
+                # The request id may come from the client, it never makes it into the path
+                self.dumps += 1
+                path: Path = self.out_dir / f"{time.strftime('%Y%m%d-%H%M%S')}-{self.dumps:06d}.prof"
+                profiler.dump_stats(path)
+                logger.info(f"Profiled request {request_id} in {time_delta:.2f} seconds, dumped to {path}")
@@ -1,62 +1,367 @@
+import asyncio
 import io
 import logging
+import os
+import time
 import uuid
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from typing import Annotated, Optional
+from typing import Annotated, Any, AsyncIterator, Awaitable, Callable, Literal, Optional, TypeVar
 
+import numpy as np
 from PIL import Image
-from fastapi import Cookie, FastAPI, Response, UploadFile
+from fastapi import Cookie, FastAPI, Form, Query, Request, Response, UploadFile, status
 from fastapi.staticfiles import StaticFiles
 
+from image_analyzer.event_store import EventStore
 from image_analyzer.image_analyzer import ImageAnalyzer
-from image_analyzer.object_detector.object_detector import DummyObjectDetector, ObjectDetector, \
-    detections_to_str
+from image_analyzer.image_describer.image_describer import ImageDescribed, ImageDescriber, base64encode, \
+    create_image_describer
+from image_analyzer.object_detector.object_detector import DetectionSet, ObjectDetector, create_object_detector, \
+    detections_to_arrays, detections_to_str
+from image_analyzer.recorder import Recorder
+from image_analyzer.tracing import RequestIdFilter, SamplingProfiler, get_timings, span, trace
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 logging.basicConfig(
-    format="%(asctime)s [%(levelname)s] %(name)s -- %(message)s",
+    format="%(asctime)s [%(levelname)s] [%(request_id)s] %(name)s -- %(message)s",
     datefmt="%m/%d/%Y %H:%M:%S",
     level=logging.INFO,
     filemode="w",
     filename="server.log",
 )
+for handler in logging.getLogger().handlers:
+    handler.addFilter(RequestIdFilter())
 
 current_dir: Path = Path(__file__).parent
 static_dir: Path = current_dir / "client" / "dist"
 logging.info(f"Starting server, serving static files from {static_dir}")
 
-# Initialize the ImageAnalyzer
-object_detector: ObjectDetector = DummyObjectDetector()
-image_describer: ImageDescriber = DummyImageDescriber()
-image_analyzer: ImageAnalyzer = ImageAnalyzer(object_detector, image_describer)
+# Backends are selected through environment variables and built in the lifespan handler,
+# so that heavy dependencies (hailo_platform, aiohttp) are imported only when selected
+object_detector_backend: str = os.environ.get("SMART_CAMERA_DETECTOR", "dummy")
+image_describer_backend: str = os.environ.get("SMART_CAMERA_DESCRIBER", "dummy")
+# Optional cheap first pass of the detector, e.g. a smaller HEF, see CascadeObjectDetector
+cascade_model: str = os.environ.get("SMART_CAMERA_CASCADE_MODEL", "")
+cascade_escalation: str = os.environ.get("SMART_CAMERA_CASCADE_ESCALATION", "candidates")
+cascade_margin: float = float(os.environ.get("SMART_CAMERA_CASCADE_MARGIN", "0.15"))
+# What the Ollama describer sends, "scene" or "crops", and how it combines requests, see OllamaImageDescriber
+describer_mode: str = os.environ.get("SMART_CAMERA_DESCRIBER_MODE", "scene")
+describer_multi_image: bool = os.environ.get("SMART_CAMERA_DESCRIBER_MULTI_IMAGE", "0") == "1"
+describer_max_batch: int = int(os.environ.get("SMART_CAMERA_DESCRIBER_MAX_BATCH", "1"))
+warm_up_detections: int = int(os.environ.get("SMART_CAMERA_WARM_UP_DETECTIONS", "3"))
+warm_up_describe: bool = os.environ.get("SMART_CAMERA_WARM_UP_DESCRIBE", "1") == "1"
+max_frame_age: float = float(os.environ.get("SMART_CAMERA_MAX_FRAME_AGE", "2.0"))
+# A backend that fails to initialize is retried, with the delay doubling up to this many seconds
+initialize_max_retry_delay: float = float(os.environ.get("SMART_CAMERA_INIT_MAX_RETRY_DELAY", "60"))
+# Path of the SQLite event log, empty (default) disables it
+event_store_path: str = os.environ.get("SMART_CAMERA_EVENT_STORE", "")
+# Delete the events older than this many seconds, 0 keeps them forever
+event_retention: float = float(os.environ.get("SMART_CAMERA_EVENT_RETENTION", str(7 * 24 * 3600)))
+# Profile one in every SMART_CAMERA_PROFILE_EVERY requests, 0 disables profiling,
+# and keep the profiles of the requests slower than SMART_CAMERA_PROFILE_MIN_DURATION seconds
+profile_every: int = int(os.environ.get("SMART_CAMERA_PROFILE_EVERY", "0"))
+profile_min_duration: float = float(os.environ.get("SMART_CAMERA_PROFILE_MIN_DURATION", "0"))
+profile_dir: Path = Path(os.environ.get("SMART_CAMERA_PROFILE_DIR", "profiles"))
+# Directory to record the frames of /api/analyze to for replay.py, an empty value disables recording
+record_dir: str = os.environ.get("SMART_CAMERA_RECORD_DIR", "")
+record_max_bytes: int = int(os.environ.get("SMART_CAMERA_RECORD_MAX_BYTES", str(1 << 30)))
+# Downscale the recorded frames to at most this width and height, 0 keeps them as they are
+record_max_w_h: int = int(os.environ.get("SMART_CAMERA_RECORD_MAX_W_H", "0"))
+
+
+@dataclass
+class BackendStatus:
+    backend: str
+    ready: bool = False
+    error: Optional[str] = None
+    warm_up_times: list[float] = field(default_factory=list)
+
+
+object_detector_status: BackendStatus = BackendStatus(object_detector_backend)
+image_describer_status: BackendStatus = BackendStatus(image_describer_backend)
+image_analyzer: Optional[ImageAnalyzer] = None
+event_store: Optional[EventStore] = None
+recorder: Optional[Recorder] = None
+profiler: Optional[SamplingProfiler] = (
+    SamplingProfiler(profile_dir, profile_every, profile_min_duration) if profile_every > 0 else None
+)
+
+
+async def retry(backend_status: BackendStatus, action: Callable[[], Awaitable[T]]) -> T:
+    """
+    Run action until it succeeds, recording the last error in backend_status and backing off between attempts.
+    """
+    delay: float = 1.
+    while True:
+        try:
+            result: T = await action()
+        except Exception as e:
+            backend_status.error = repr(e)
+            logger.exception(f"Failed to initialize the {backend_status.backend} backend, retrying in {delay:.0f} s")
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, initialize_max_retry_delay)
+            continue
+        backend_status.error = None
+        return result
+
+
+async def build_object_detector() -> ObjectDetector:
+    object_detector: ObjectDetector = await asyncio.to_thread(
+        create_object_detector, object_detector_backend, cascade_model or None, cascade_escalation, cascade_margin
+    )
+    object_detector_status.warm_up_times = await object_detector.warm_up(warm_up_detections)
+    return object_detector
+
+
+async def initialize() -> None:
+    """
+    Build the backends and warm them up. Runs in the background so that /healthz answers while the models are loading.
+    The ImageAnalyzer is published once the object detector is ready, so that /api/detect does not wait for
+    the image describer; /api/analyze waits for both.
+    """
+    global image_analyzer
+
+    object_detector: ObjectDetector = await retry(object_detector_status, build_object_detector)
+    object_detector_status.ready = True
+
+    image_describer: ImageDescriber = await retry(image_describer_status, lambda: asyncio.to_thread(
+        create_image_describer, image_describer_backend, describer_mode, describer_multi_image, describer_max_batch
+    ))
+    image_analyzer = ImageAnalyzer(object_detector, image_describer, max_frame_age, event_store=event_store)
+    logger.info(f"Object detector is ready: {object_detector_status}")
+
+    if warm_up_describe:
+        image_describer_status.warm_up_times = [await retry(image_describer_status, image_describer.warm_up)]
+    image_describer_status.ready = True
+    logger.info(
+        f"Server is ready, object detector: {object_detector_status}, image describer: {image_describer_status}"
+    )
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    global event_store, recorder
+
+    if event_store_path:
+        event_store = EventStore(Path(event_store_path), retention=event_retention or None)
+        event_store.start()
+    if record_dir:
+        recorder = Recorder(Path(record_dir), record_max_bytes, record_max_w_h or None)
+    task: asyncio.Task = asyncio.create_task(initialize())
+    yield
+    task.cancel()
+    if event_store is not None:
+        await event_store.stop()
+    if recorder is not None:
+        await recorder.close()
+
+
+def get_readiness() -> dict[str, Any]:
+    return {
+        "ready": object_detector_status.ready and image_describer_status.ready,
+        "object_detector": asdict(object_detector_status),
+        "image_describer": asdict(image_describer_status),
+    }
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def trace_request(request: Request, call_next: Callable[[Request], Awaitable[Response]]) -> Response:
+    """
+    Trace the API requests: the request id is logged with every record and returned in X-Request-ID,
+    the duration of each stage is returned in Server-Timing.
+    """
+    if not request.url.path.startswith("/api/"):
+        return await call_next(request)
+
+    with trace(request.headers.get("X-Request-ID")) as request_trace:
+        if profiler is None:
+            response: Response = await call_next(request)
+        else:
+            with profiler.profile(request_trace.request_id):
+                response = await call_next(request)
+
+    response.headers["X-Request-ID"] = request_trace.request_id
+    response.headers["Server-Timing"] = request_trace.server_timing()
+    return response
+
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok", **get_readiness()}
+
 
-app = FastAPI()
+@app.get("/readyz")
+async def readyz(response: Response):
+    if not (object_detector_status.ready and image_describer_status.ready):
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return get_readiness()
 
 
 @app.post("/api/analyze")
 async def analyze(
         response: Response,
         file: UploadFile,
+        # How long the client held the frame before uploading it, in milliseconds
+        frame_age: Annotated[Optional[float], Form()] = None,
         user: Annotated[Optional[str], Cookie()] = None
 ):
+    if image_analyzer is None or not image_describer_status.ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"message": "Server is not ready yet."}
+
     if not user:
         user = str(uuid.uuid4())
         response.set_cookie(key="user", value=user)
         logging.info(f"Created new user cookie: {user}")
 
-    contents = await file.read()
-    image: Image.Image = Image.open(io.BytesIO(contents))
+    with span("decode"):
+        contents = await file.read()
+        image: Image.Image = Image.open(io.BytesIO(contents))
+        image.load()
+    if recorder is not None:
+        recorder.record(user, image, time.time())
 
     # Analyze the image
-    image_described: ImageDescribed = await image_analyzer.analyze(user, image)
+    image_described: ImageDescribed = await image_analyzer.analyze(
+        user, image, None if frame_age is None else frame_age / 1000
+    )
 
+    # Dropped frames were never annotated, there is nothing worth showing
+    dropped: bool = image_described.status in ["expired", "superseded"]
+    with span("encode"):
+        image_encoded: Optional[str] = None if dropped else base64encode(image_described.image.image_detected)
     return {
-        "image": base64encode(image_described.image.image_detected),
+        "image": image_encoded,
         "status": image_described.status,
         "detections": detections_to_str(image_described.image.detections),
         "description": image_described.description,
         "time": image_described.time,
+        "timings": get_timings(),
+        "next_capture_delay": image_analyzer.suggest_capture_delay(user),
+    }
+
+
+# Record layout of the binary /api/detect responses, one record per detection
+# The box is (ymin, xmin, ymax, xmax) normalized to the uploaded image
+detection_dtype: np.dtype = np.dtype([
+    ("image", "<u2"), ("class_id", "<u2"), ("score", "<f4"), ("box", "<f4", (4,))
+])
+
+
+def detections_to_json(detect_status: str, detections: Optional[DetectionSet]) -> dict[str, Any]:
+    boxes, scores, class_ids = detections_to_arrays(detections or [])
+    # Four decimals are well below a pixel and keep the JSON compact
+    return {
+        "status": detect_status,
+        "boxes": boxes.astype(np.float64).round(4).tolist(),
+        "scores": scores.astype(np.float64).round(4).tolist(),
+        "class_ids": class_ids.tolist(),
+    }
+
+
+def detections_to_binary(detections_batch: list[tuple[str, Optional[DetectionSet]]]) -> Response:
+    """
+    Pack the detections of a batch into detection_dtype records.
+    The status of each image is listed in the X-Detect-Status header, in order.
+    """
+    records: list[np.ndarray] = []
+    for i, (_, detections) in enumerate(detections_batch):
+        boxes, scores, class_ids = detections_to_arrays(detections or [])
+        record: np.ndarray = np.empty(len(scores), dtype=detection_dtype)
+        record["image"], record["class_id"], record["score"], record["box"] = i, class_ids, scores, boxes
+        records.append(record)
+
+    return Response(
+        content=np.concatenate(records).tobytes() if records else b"",
+        media_type="application/octet-stream",
+        headers={"X-Detect-Status": ",".join(detect_status for detect_status, _ in detections_batch)},
+    )
+
+
+async def detect_files(
+        files: list[UploadFile], frame_age: Optional[float], user: Optional[str]
+) -> list[tuple[str, Optional[DetectionSet]]]:
+    # The images go through the frame scheduler one at a time, so a batch does not starve the other users.
+    # Callers without a cookie each get their own slot, the frames of one caller must not supersede another's
+    scheduler_key: str = user or f"anonymous-{uuid.uuid4()}"
+    detections_batch: list[tuple[str, Optional[DetectionSet]]] = []
+    for file in files:
+        with span("decode"):
+            try:
+                image: Image.Image = Image.open(io.BytesIO(await file.read()))
+                image.load()
+            except OSError:
+                # PIL.UnidentifiedImageError for unknown formats, a plain OSError for truncated files
+                logger.warning(f"Invalid image in upload {file.filename}")
+                detections_batch.append(("invalid", None))
+                continue
+        detections_batch.append(await image_analyzer.detect(
+            scheduler_key, image, None if frame_age is None else frame_age / 1000
+        ))
+    return detections_batch
+
+
+@app.post("/api/detect")
+async def detect(
+        file: UploadFile,
+        frame_age: Annotated[Optional[float], Form()] = None,
+        format: Literal["json", "binary"] = "json",
+        user: Annotated[Optional[str], Cookie()] = None
+):
+    if image_analyzer is None:
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    detections_batch: list[tuple[str, Optional[DetectionSet]]] = await detect_files([file], frame_age, user)
+    if format == "binary":
+        return detections_to_binary(detections_batch)
+    return detections_to_json(*detections_batch[0])
+
+
+@app.post("/api/detect/batch")
+async def detect_batch(
+        files: list[UploadFile],
+        frame_age: Annotated[Optional[float], Form()] = None,
+        format: Literal["json", "binary"] = "json",
+        user: Annotated[Optional[str], Cookie()] = None
+):
+    if image_analyzer is None:
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    detections_batch: list[tuple[str, Optional[DetectionSet]]] = await detect_files(files, frame_age, user)
+    if format == "binary":
+        return detections_to_binary(detections_batch)
+    return {"results": [detections_to_json(*result) for result in detections_batch]}
+
+
+@app.get("/api/events")
+async def events(
+        response: Response,
+        user: Optional[str] = None,
+        class_name: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+        until_id: Optional[int] = None,
+        limit: Annotated[int, Query(ge=1, le=1000)] = 100
+):
+    if event_store is None:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return {"message": "The event store is disabled."}
+
+    events_page: list[dict[str, Any]] = await event_store.query(user, class_name, since, until, until_id, limit)
+    # The next page starts right after the oldest event of this page, in (timestamp, id) order
+    last: Optional[dict[str, Any]] = events_page[-1] if len(events_page) == limit else None
+    return {
+        "events": events_page,
+        "next_until": None if last is None else last["timestamp"],
+        "next_until_id": None if last is None else last["id"],
     }
 
 
@@ -68,7 +373,8 @@ async def refresh(
     if not user:
         return {"message": "No user cookie found."}
     response.delete_cookie("user")
-    image_analyzer.refresh(user)
+    if image_analyzer is not None:
+        image_analyzer.refresh(user)
     return {"message": "User cookie deleted."}
 
 
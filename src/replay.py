@@ -0,0 +1,134 @@
+"""
+Replay an archive recorded by the server (SMART_CAMERA_RECORD_DIR) through the ImageAnalyzer and report
+throughput, latency and describer calls.
+
+    python replay.py [archive_dir] --speed 1   # at the recorded speed
+    python replay.py [archive_dir] --speed 10  # ten times faster
+    python replay.py [archive_dir] --speed 0   # as fast as possible, one frame at a time
+"""
+import argparse
+import asyncio
+import logging
+import time
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+from image_analyzer.image_analyzer import ImageAnalyzer
+from image_analyzer.image_describer.image_describer import ImageDescribed, create_image_describer
+from image_analyzer.object_detector.object_detector import CascadeObjectDetector, ObjectDetector, create_object_detector
+from image_analyzer.recorder import Record, RecordEntry, read_index
+
+logger = logging.getLogger(__name__)
+
+
+async def replay(image_analyzer: ImageAnalyzer, records: list[RecordEntry], speed: float) -> None:
+    """
+    :param records: The entries of the records to replay in arrival order. Each image is decoded right before
+                    it is submitted, so that only the frames in flight are held in memory.
+    """
+    latencies: list[float] = []
+    statuses: Counter[str] = Counter()
+
+    async def analyze(record: Record) -> None:
+        time_s: float = time.time()
+        image_described: ImageDescribed = await image_analyzer.analyze(record.user, record.image)
+        latencies.append(time.time() - time_s)
+        statuses[image_described.status] += 1
+
+    time_s: float = time.time()
+    if speed > 0:
+        tasks: list[asyncio.Task] = []
+        for record in records:
+            delay: float = (record.arrival - records[0].arrival) / speed - (time.time() - time_s)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(analyze(record.load())))
+        await asyncio.gather(*tasks)
+    else:
+        for record in records:
+            await analyze(record.load())
+    time_delta: float = time.time() - time_s
+
+    latencies_ms: np.ndarray = np.array(latencies) * 1000
+    print(f"frames: {len(records)}, users: {len({record.user for record in records})}")
+    print(f"wall time: {time_delta:.2f} s, throughput: {len(records) / time_delta:.2f} frames/s")
+    print(
+        f"latency: p50 {np.percentile(latencies_ms, 50):.1f} ms, p95 {np.percentile(latencies_ms, 95):.1f} ms, "
+        f"max {latencies_ms.max():.1f} ms"
+    )
+    print(f"statuses: {dict(statuses)}")
+    # A batching describer answers several successful descriptions with one call
+    print(f"describer calls: {image_analyzer.image_describer.model_calls}")
+    object_detector: ObjectDetector = image_analyzer.object_detector
+    if isinstance(object_detector, CascadeObjectDetector):
+        print(
+            f"cascade escalations: {object_detector.escalations} of {object_detector.frames} frames "
+            f"({object_detector.escalations / max(object_detector.frames, 1):.1%})"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay recorded traffic through the ImageAnalyzer.")
+    parser.add_argument("archive_dir", type=Path)
+    parser.add_argument(
+        "--speed", type=float, default=1.,
+        help="Replay speed relative to the recording, 0 replays as fast as possible"
+    )
+    parser.add_argument("--detector", default="dummy", help="Object detector backend: dummy or hailo")
+    parser.add_argument(
+        "--cascade-model", default=None,
+        help="HEF file of the cheap first pass of the hailo detector, as SMART_CAMERA_CASCADE_MODEL"
+    )
+    parser.add_argument(
+        "--cascade-escalation", default="candidates", choices=["candidates", "ambiguous"],
+        help="Escalation policy of the cascade, as SMART_CAMERA_CASCADE_ESCALATION"
+    )
+    parser.add_argument(
+        "--cascade-margin", type=float, default=0.15,
+        help="Confidence margin of the cascade, as SMART_CAMERA_CASCADE_MARGIN"
+    )
+    parser.add_argument("--describer", default="dummy", help="Image describer backend: dummy or ollama")
+    parser.add_argument(
+        "--describer-mode", default="scene", choices=["scene", "crops"],
+        help="What the ollama describer sends, as SMART_CAMERA_DESCRIBER_MODE"
+    )
+    parser.add_argument(
+        "--describer-multi-image", action="store_true",
+        help="The ollama model accepts several images per request, as SMART_CAMERA_DESCRIBER_MULTI_IMAGE"
+    )
+    parser.add_argument(
+        "--describer-max-batch", type=int, default=1,
+        help="Scenes the ollama describer combines into one request, as SMART_CAMERA_DESCRIBER_MAX_BATCH"
+    )
+    parser.add_argument("--limit", type=int, default=None, help="Replay at most this many frames")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s [%(levelname)s] %(name)s -- %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.WARNING
+    )
+
+    records: list[RecordEntry] = []
+    for record in read_index(args.archive_dir):
+        if args.limit is not None and len(records) >= args.limit:
+            break
+        records.append(record)
+    if not records:
+        raise SystemExit(f"No records found in {args.archive_dir}")
+    # The pacing assumes arrival order, which archives recorded by older versions did not guarantee
+    records.sort(key=lambda record: record.arrival)
+
+    image_analyzer: ImageAnalyzer = ImageAnalyzer(
+        create_object_detector(args.detector, args.cascade_model, args.cascade_escalation, args.cascade_margin),
+        create_image_describer(
+            args.describer, args.describer_mode, args.describer_multi_image, args.describer_max_batch
+        )
+    )
+    asyncio.run(replay(image_analyzer, records, args.speed))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,21 @@
 import asyncio
 import logging
+import tempfile
+import time
 import unittest
 from pathlib import Path
 
+import numpy as np
 from PIL import Image
 
+from image_analyzer.event_store import Event, EventStore
+from image_analyzer.image_analyzer import ImageAnalyzer, get_new_detections
 from image_analyzer.image_describer.image_describer import DummyImageDescriber, ImageDescribed
-from image_analyzer.object_detector.object_detector import Detection, DummyObjectDetector, ImageObjectDetected
+from image_analyzer.object_detector.frame_scheduler import ADMITTED, EXPIRED, SUPERSEDED, Frame, FrameScheduler
+from image_analyzer.object_detector.object_detector import CascadeObjectDetector, Detection, DetectionSet, \
+    DummyObjectDetector, ImageObjectDetected, ObjectDetector, create_object_detector, detections_to_str
+from image_analyzer.recorder import Record, RecordEntry, Recorder, read_index, read_records
+from image_analyzer.tracing import SamplingProfiler, Trace, get_timings, span, trace
 
 logger = logging.getLogger(__name__)
 
@@ -28,13 +37,107 @@ class TestObjectDetector(unittest.TestCase):
         self.assertEqual(res.image_detected.size, (300, 300))
         self.assertEqual(len(res.detections), 1)
         detection: Detection = res.detections[0]
-        self.assertEqual(detection.box, (0.1, 0.1, 0.9, 0.9))
-        self.assertEqual(detection.score, 0.9)
+        np.testing.assert_allclose(detection.box, (0.1, 0.1, 0.9, 0.9), rtol=1e-6)
+        self.assertAlmostEqual(detection.score, 0.9, places=6)
         self.assertEqual(detection.class_id, 0)
         self.assertEqual(detection.class_name, "dummy")
         self.assertEqual(self.img, res.image)
         res.image_detected.save(self.resource_dir / "tmp" / "test_detect.png")
 
+    def test_detect_boxes(self):
+        detections: list[Detection] = asyncio.run(self.detector.detect_boxes(self.img))
+        self.assertEqual(len(detections), 1)
+        # img1 is portrait, so the letterbox padding is on the left and right
+        ymin, xmin, ymax, xmax = detections[0].box
+        self.assertAlmostEqual(ymin, 0.1)
+        self.assertAlmostEqual(ymax, 0.9)
+        self.assertEqual((xmin, xmax), (0., 1.))
+
+    def test_to_image_box(self):
+        box = self.detector.to_image_box((0.5, 0.5, 0.5, 0.5), self.img.size)
+        for value in box:
+            self.assertAlmostEqual(value, 0.5, places=2)
+
+    def test_warm_up(self):
+        times: list[float] = asyncio.run(self.detector.warm_up(2))
+        self.assertEqual(len(times), 2)
+        self.assertTrue(all(t >= 0 for t in times))
+
+
+class TestDetectionSet(unittest.TestCase):
+    def setUp(self):
+        self.detections: DetectionSet = DetectionSet(
+            np.array([[0.1, 0.1, 0.5, 0.5], [0.2, 0.2, 0.6, 0.6], [0.3, 0.3, 0.7, 0.7]]),
+            np.array([0.9, 0.8, 0.7]), np.array([16, 0, 16]), {0: "person", 16: "dog"}
+        )
+
+    def test_class_counts(self):
+        self.assertEqual(list(self.detections.class_counts.items()), [("dog", 2), ("person", 1)])
+        self.assertIs(self.detections.class_counts, self.detections.class_counts)
+        self.assertEqual(detections_to_str(self.detections), "dog: 2\nperson: 1")
+        self.assertEqual(self.detections.signature, DetectionSet.from_detections(list(self.detections)).signature)
+
+    def test_getitem(self):
+        detection: Detection = self.detections[1]
+        self.assertEqual((detection.class_id, detection.class_name), (0, "person"))
+        np.testing.assert_allclose(detection.box, (0.2, 0.2, 0.6, 0.6), rtol=1e-6)
+        self.assertAlmostEqual(detection.score, 0.8, places=6)
+        self.assertEqual((self.detections.boxes.dtype, self.detections.class_ids.dtype), (np.float32, np.uint16))
+        self.assertEqual(len(self.detections[self.detections.scores > 0.75]), 2)
+        self.assertFalse(hasattr(self.detections, "__dict__"))
+        self.assertFalse(hasattr(self.detections[0], "__dict__"))
+
+
+class FixedObjectDetector(ObjectDetector):
+    def __init__(self, size: int, scores: list[float]):
+        super().__init__(preprocess_width=size, preprocess_height=size)
+        self.scores: list[float] = scores
+        self.calls: int = 0
+
+    async def detect_objects(self, image_preprocessed: Image.Image) -> list[Detection]:
+        self.calls += 1
+        return [
+            Detection(box=(0.1, 0.1, 0.9, 0.9), score=score, class_id=0, class_name="fixed") for score in self.scores
+        ]
+
+
+class TestCascadeObjectDetector(unittest.TestCase):
+    def setUp(self):
+        self.img: Image.Image = Image.open(Path(__file__).parent / "resources" / "img1.png")
+
+    def detect(self, cheap: FixedObjectDetector, escalation: str) -> tuple[list[Detection], FixedObjectDetector]:
+        full: FixedObjectDetector = FixedObjectDetector(300, [0.95, 0.9])
+        detector: CascadeObjectDetector = CascadeObjectDetector(cheap, full, escalation, margin=0.15)
+        return asyncio.run(detector.detect(self.img)).detections, full
+
+    def test_empty(self):
+        detections, full = self.detect(FixedObjectDetector(100, [0.2]), "candidates")
+        self.assertEqual((len(detections), full.calls), (0, 0))
+
+    def test_candidates(self):
+        detections, full = self.detect(FixedObjectDetector(100, [0.4]), "candidates")
+        self.assertEqual((len(detections), full.calls), (2, 1))
+
+    def test_ambiguous(self):
+        detections, full = self.detect(FixedObjectDetector(100, [0.9]), "ambiguous")
+        self.assertEqual((len(detections), full.calls), (1, 0))
+        np.testing.assert_allclose(detections[0].box, (0.1, 0.1, 0.9, 0.9), rtol=1e-6)
+        detections, full = self.detect(FixedObjectDetector(100, [0.9, 0.55]), "ambiguous")
+        self.assertEqual((len(detections), full.calls), (2, 1))
+
+    def test_create(self):
+        self.assertIsInstance(create_object_detector("dummy"), DummyObjectDetector)
+        with self.assertRaises(ValueError):
+            create_object_detector("dummy", cheap_model="cheap.hef")
+        with self.assertRaises(ValueError):
+            create_object_detector("hailo", cheap_model="cheap.hef", escalation="always")
+
+    def test_warm_up(self):
+        cheap: FixedObjectDetector = FixedObjectDetector(100, [])
+        full: FixedObjectDetector = FixedObjectDetector(300, [])
+        asyncio.run(CascadeObjectDetector(cheap, full).warm_up(1))
+        self.assertEqual((cheap.calls, full.calls), (1, 1))
+
 
 class TestHailoObjectDetector(unittest.TestCase):
     def setUp(self):
@@ -70,6 +173,350 @@ class TestImageDescriber(unittest.TestCase):
         self.assertEqual(description.description, "A dummy description")
         self.assertEqual(description.status, "success")
 
+    def test_warm_up(self):
+        time_delta: float = asyncio.run(self.describer.warm_up())
+        self.assertGreater(time_delta, 0)
+        self.assertFalse(self.describer.processing)
+        self.assertEqual(self.describer.model_calls, 1)
+
+
+class TestFrameScheduler(unittest.TestCase):
+    def setUp(self):
+        self.img: Image.Image = Image.open(Path(__file__).parent / "resources" / "img1.png")
+
+    def frame(self, user: str, deadline: float = float("inf")) -> Frame:
+        return Frame(image=self.img, user=user, captured_at=0., deadline=deadline)
+
+    def test_expired(self):
+        scheduler: FrameScheduler = FrameScheduler()
+        self.assertEqual(asyncio.run(scheduler.acquire(self.frame("a", deadline=0.))), EXPIRED)
+        self.assertFalse(scheduler.busy)
+
+    def test_round_robin(self):
+        async def run() -> list[str]:
+            scheduler: FrameScheduler = FrameScheduler(max_pending_per_user=2)
+            order: list[str] = []
+
+            async def job(frame: Frame) -> None:
+                if await scheduler.acquire(frame) == ADMITTED:
+                    order.append(frame.user)
+                    await asyncio.sleep(0)
+                    scheduler.release()
+
+            await asyncio.gather(*[job(self.frame(user)) for user in ["a", "a", "a", "b", "b", "c"]])
+            self.assertFalse(scheduler.busy)
+            return order
+
+        self.assertEqual(asyncio.run(run()), ["a", "a", "b", "c", "a", "b"])
+
+    def test_superseded(self):
+        async def run() -> list[str]:
+            scheduler: FrameScheduler = FrameScheduler()
+            self.assertEqual(await scheduler.acquire(self.frame("a")), ADMITTED)
+            old: asyncio.Task = asyncio.create_task(scheduler.acquire(self.frame("b")))
+            await asyncio.sleep(0)
+            new: asyncio.Task = asyncio.create_task(scheduler.acquire(self.frame("b")))
+            await asyncio.sleep(0)
+            scheduler.release()
+            return [await old, await new]
+
+        self.assertEqual(asyncio.run(run()), [SUPERSEDED, ADMITTED])
+
+
+class TestImageAnalyzer(unittest.TestCase):
+    def setUp(self):
+        self.analyzer = ImageAnalyzer(DummyObjectDetector(), DummyImageDescriber(), max_frame_age=1.)
+        self.img: Image.Image = Image.open(Path(__file__).parent / "resources" / "img1.png")
+
+    def test_expired(self):
+        res: ImageDescribed = asyncio.run(self.analyzer.analyze("user", self.img, frame_age=5.))
+        self.assertEqual(res.status, "expired")
+        self.assertEqual(len(res.image.detections), 0)
+
+    def test_detect_superseded(self):
+        async def run(users: list[str]) -> list[str]:
+            return [status for status, _ in await asyncio.gather(*[self.analyzer.detect(u, self.img) for u in users])]
+
+        self.assertEqual(asyncio.run(run(["a", "a", "a"])), ["success", "superseded", "success"])
+        self.assertEqual(asyncio.run(run(["a", "b", "c"])), ["success"] * 3)
+
+    def test_fresh(self):
+        # A client clock running behind must not expire the frames
+        res: ImageDescribed = asyncio.run(self.analyzer.analyze("user", self.img, frame_age=-5.))
+        self.assertEqual(res.status, "success")
+
+    def test_get_new_detections(self):
+        def image(scores: list[tuple[str, float]]) -> ImageObjectDetected:
+            class_ids: dict[str, int] = {"person": 0, "dog": 16}
+            detections: DetectionSet = DetectionSet.from_detections([
+                Detection(box=(0., 0., 1., 1.), score=score, class_id=class_ids[class_name], class_name=class_name)
+                for class_name, score in scores
+            ])
+            return ImageObjectDetected(image=self.img, image_detected=self.img, detections=detections)
+
+        prev_image: ImageObjectDetected = image([("person", 0.9)])
+        new_detections: list[Detection] = get_new_detections(
+            image([("person", 0.6), ("person", 0.8), ("dog", 0.7)]), prev_image
+        )
+        self.assertEqual([d.class_name for d in new_detections], ["person", "dog"])
+        np.testing.assert_allclose([d.score for d in new_detections], [0.8, 0.7], rtol=1e-6)
+        self.assertEqual(len(get_new_detections(prev_image, None)), 1)
+
+    def test_suggest_capture_delay(self):
+        self.assertEqual(self.analyzer.suggest_capture_delay("user"), self.analyzer.min_capture_delay)
+        self.analyzer.static_frames["user"] = self.analyzer.static_backoff_frames
+        self.assertEqual(self.analyzer.suggest_capture_delay("user"), 2 * self.analyzer.min_capture_delay)
+        self.analyzer.static_frames["user"] = 4096
+        self.assertEqual(self.analyzer.suggest_capture_delay("user"), self.analyzer.max_capture_delay)
+        self.analyzer.refresh("user")
+        self.assertEqual(self.analyzer.suggest_capture_delay("user"), self.analyzer.min_capture_delay)
+
+    def test_static_frames_bounded(self):
+        for _ in range(self.analyzer.max_static_frames + 3):
+            asyncio.run(self.analyzer.analyze("user", self.img))
+        self.assertEqual(self.analyzer.static_frames["user"], self.analyzer.max_static_frames)
+        self.assertEqual(self.analyzer.suggest_capture_delay("user"), self.analyzer.max_capture_delay)
+
+
+class TestTracing(unittest.TestCase):
+    def test_span(self):
+        with trace("request") as request_trace:
+            with span("stage"):
+                pass
+            with span("stage"):
+                pass
+            with trace() as inner_trace:
+                self.assertIs(inner_trace, request_trace)
+        self.assertEqual(list(request_trace.timings), ["stage"])
+        self.assertEqual(get_timings(), {})
+        self.assertRegex(Trace("request", {"a": 0.0012}).server_timing(), r"^a;dur=1\.2$")
+
+    def test_request_id(self):
+        with trace("abc-123") as request_trace:
+            self.assertEqual(request_trace.request_id, "abc-123")
+        for request_id in ["../../evil", "a" * 65, ""]:
+            with trace(request_id) as request_trace:
+                self.assertRegex(request_trace.request_id, r"^[0-9a-f]{16}$")
+
+    def test_profiler(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            profiler: SamplingProfiler = SamplingProfiler(Path(tmp_dir) / "profiles", every_n=1)
+            with profiler.profile("../../evil"):
+                pass
+            self.assertEqual([path.suffix for path in (Path(tmp_dir) / "profiles").iterdir()], [".prof"])
+            self.assertEqual([path.name for path in Path(tmp_dir).iterdir()], ["profiles"])
+
+    def test_analyze(self):
+        analyzer: ImageAnalyzer = ImageAnalyzer(DummyObjectDetector(), DummyImageDescriber())
+        img: Image.Image = Image.open(Path(__file__).parent / "resources" / "img1.png")
+        res: ImageDescribed = asyncio.run(analyzer.analyze("user", img))
+        self.assertEqual(list(res.timings), ["queue", "preprocess", "inference", "draw", "describe"])
+
+
+class TestEventStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path: Path = Path(self.tmp_dir.name) / "events.db"
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_query(self):
+        async def run() -> None:
+            store: EventStore = EventStore(self.path, flush_interval=0.)
+            store.start()
+            for i, (user, class_counts) in enumerate([
+                ("cam1", {"person": 1}), ("cam3", {"person": 2, "dog": 1}), ("cam3", {"dog": 1}), ("cam3", {})
+            ]):
+                store.append(Event(
+                    user=user, timestamp=float(i), status="success", class_counts=class_counts,
+                    boxes=[], description="", timings={}
+                ))
+            await store.stop()
+
+            store = EventStore(self.path)
+            last_seen = await store.query(user="cam3", class_name="person", limit=1)
+            self.assertEqual([event["timestamp"] for event in last_seen], [1.])
+            self.assertEqual(last_seen[0]["class_counts"], {"person": 2, "dog": 1})
+
+            page = await store.query(user="cam3", limit=2)
+            self.assertEqual([event["timestamp"] for event in page], [3., 2.])
+            page = await store.query(user="cam3", until=page[-1]["timestamp"], until_id=page[-1]["id"], limit=2)
+            self.assertEqual([event["timestamp"] for event in page], [1.])
+            await store.stop()
+
+        asyncio.run(run())
+
+    def test_stop_keeps_in_flight_events(self):
+        async def run() -> int:
+            store: EventStore = EventStore(self.path, flush_interval=10.)
+            store.start()
+            for i in range(3):
+                store.append(Event(
+                    user="cam", timestamp=float(i), status="success", class_counts={}, boxes=[], description="",
+                    timings={}
+                ))
+            await asyncio.sleep(0.1)
+            time_s: float = time.time()
+            await store.stop()
+            self.assertLess(time.time() - time_s, 1.)
+            store = EventStore(self.path)
+            events: list[dict] = await store.query()
+            await store.stop()
+            return len(events)
+
+        self.assertEqual(asyncio.run(run()), 3)
+
+    def test_tied_timestamps(self):
+        async def run() -> None:
+            store: EventStore = EventStore(self.path, flush_interval=0.)
+            store.start()
+            for user in ["cam1", "cam2", "cam3"]:
+                store.append(Event(
+                    user=user, timestamp=1., status="success", class_counts={"person": 1}, boxes=[], description="",
+                    timings={}
+                ))
+            await store.stop()
+
+            store = EventStore(self.path)
+            for class_name in [None, "person"]:
+                users: list[str] = []
+                page = await store.query(class_name=class_name, limit=2)
+                users += [event["user"] for event in page]
+                page = await store.query(
+                    class_name=class_name, until=page[-1]["timestamp"], until_id=page[-1]["id"], limit=2
+                )
+                users += [event["user"] for event in page]
+                self.assertEqual(users, ["cam3", "cam2", "cam1"])
+            await store.stop()
+
+        asyncio.run(run())
+
+    def test_retention(self):
+        async def run() -> int:
+            store: EventStore = EventStore(self.path, flush_interval=0., retention=60.)
+            store.start()
+            for timestamp in [time.time() - 120, time.time()]:
+                store.append(Event(
+                    user="cam", timestamp=timestamp, status="success", class_counts={"person": 1}, boxes=[],
+                    description="", timings={}
+                ))
+            await store.stop()
+            store = EventStore(self.path)
+            events: list[dict] = await store.query(class_name="person")
+            await store.stop()
+            return len(events)
+
+        self.assertEqual(asyncio.run(run()), 1)
+
+
+class TestRecorder(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.archive_dir: Path = Path(self.tmp_dir.name) / "archive"
+        self.img: Image.Image = Image.open(Path(__file__).parent / "resources" / "img1.png")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_record(self):
+        async def run() -> None:
+            recorder: Recorder = Recorder(self.archive_dir, max_w_h=64)
+            for i in range(3):
+                recorder.record(f"user{i}", self.img, float(i))
+                await asyncio.sleep(0.1)
+            await recorder.close()
+
+        asyncio.run(run())
+        records: list[Record] = list(read_records(self.archive_dir))
+        self.assertEqual(
+            [(record.arrival, record.user) for record in records], [(0., "user0"), (1., "user1"), (2., "user2")]
+        )
+        self.assertEqual(max(records[0].image.size), 64)
+
+    def test_order(self):
+        # A large frame takes longer to encode, the small frame that follows must not overtake it
+        async def run() -> None:
+            recorder: Recorder = Recorder(self.archive_dir)
+            recorder.record("a", Image.new("RGB", (3000, 3000)), 1.)
+            recorder.record("b", Image.new("RGB", (8, 8)), 2.)
+            await recorder.close()
+
+        asyncio.run(run())
+        self.assertEqual(
+            [(record.user, record.arrival) for record in read_records(self.archive_dir)], [("a", 1.), ("b", 2.)]
+        )
+
+    def test_read_index(self):
+        recorder: Recorder = Recorder(self.archive_dir, max_w_h=64)
+        for i in range(2):
+            recorder.write(f"user{i}", self.img, float(i))
+        asyncio.run(recorder.close())
+        # A record cut short by a crash is skipped
+        segment: Path = next(self.archive_dir.iterdir())
+        segment.write_bytes(segment.read_bytes()[:-10])
+
+        entries: list[RecordEntry] = list(read_index(self.archive_dir))
+        self.assertEqual([(entry.arrival, entry.user) for entry in entries], [(0., "user0")])
+        self.assertEqual(max(entries[0].load().image.size), 64)
+
+    def test_max_bytes(self):
+        recorder: Recorder = Recorder(self.archive_dir, max_bytes=4000, max_w_h=64)
+        for i in range(20):
+            recorder.write("user", self.img, float(i))
+        asyncio.run(recorder.close())
+        records: list[Record] = list(read_records(self.archive_dir))
+        self.assertLess(len(records), 20)
+        self.assertEqual(records[-1].arrival, 19.)
+
+
+class TestOllamaCrops(unittest.TestCase):
+    def setUp(self):
+        from image_analyzer.image_describer.ollama_image_describer import OllamaImageDescriber
+        self.describer = OllamaImageDescriber(mode="crops")
+        self.img: Image.Image = Image.open(Path(__file__).parent / "resources" / "img2.png")
+        self.img_detected: ImageObjectDetected = asyncio.run(DummyObjectDetector().detect(self.img))
+
+    def test_crop(self):
+        detection: Detection = Detection(box=(0.45, 0.45, 0.55, 0.55), score=0.9, class_id=0, class_name="dummy")
+        crop: Image.Image = self.describer.get_crop(self.img_detected, detection)
+        self.assertEqual(max(crop.size), self.describer.max_w_h)
+
+    def test_tile(self):
+        detections: list[Detection] = [
+            Detection(box=(0.1 * i, 0.1 * i, 0.1 * i + 0.2, 0.1 * i + 0.2), score=0.9, class_id=0, class_name="dummy")
+            for i in range(3)
+        ]
+        tiled: Image.Image = self.describer.tile([self.describer.get_crop(self.img_detected, d) for d in detections])
+        self.assertEqual(tiled.size, (self.describer.max_w_h, self.describer.max_w_h))
+
+    def test_split_batch_response(self):
+        from image_analyzer.image_describer.ollama_image_describer import split_batch_response
+        response: str = "1: A person.\nImage 2) A dog."
+        self.assertEqual(split_batch_response(response, 3), ["A person.", "A dog.", None])
+        self.assertEqual(split_batch_response("A person and a dog.", 2), [None, None])
+
+    def test_unnumbered_batch_response(self):
+        from image_analyzer.image_describer.ollama_image_describer import OllamaImageDescriber
+
+        class ScriptedOllamaImageDescriber(OllamaImageDescriber):
+            def __init__(self):
+                super().__init__(multi_image=True, max_batch=3)
+                self.prompts: list[str] = []
+
+            async def query_images(self, prompt: str, images: list[str]) -> str:
+                self.prompts.append(prompt)
+                return "Scene of every camera." if len(images) > 1 else f"Scene {len(self.prompts)}."
+
+        async def run() -> list[ImageDescribed]:
+            return await asyncio.gather(*[describer.describe(self.img_detected) for _ in range(2)])
+
+        describer: ScriptedOllamaImageDescriber = ScriptedOllamaImageDescriber()
+        descriptions: list[str] = sorted(res.description for res in asyncio.run(run()))
+        # The combined response is never handed out, each scene is described again on its own
+        self.assertEqual(descriptions, ["Scene 2.", "Scene 3."])
+        self.assertEqual(len(describer.prompts), 3)
+
 
 class TestOllamaImageDescriber(unittest.TestCase):
     def setUp(self):